@@ -1,5 +1,5 @@
 """ Module providing helper functions to create tables and plot figures """
-from typing import Union
+from typing import Optional, Union
 
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
@@ -9,6 +9,8 @@ import numpy as np
 import pandas as pd
 import statsmodels.api as sm
 
+from pipeline.paper import TABLE6_MIN_FIRMS
+
 # To make the figures pretty
 plt.rcParams.update(rcParamsDefault)
 plt.rcParams["text.latex.preamble"].join([
@@ -24,31 +26,30 @@ rc('text', usetex=True)
 
 def prepare_table_1(
     coverage_file: str,
+    cube_file: str,
     worldscope_file: str,
-    gdp_file: str
+    gdp_file: str,
+    year: int = 2019
 ):
-    # Load coverage data
+    # Load coverage data and its year x country aggregates
     data_coverage = pd.read_pickle(coverage_file)
+    cube = pd.read_pickle(cube_file)
     # Load auxiliary data
     worldscope = import_worldscope(worldscope_file, data_coverage)
     gdp = pd.read_csv(gdp_file).set_index('country_name')
     # Collect 45 countries
-    our_countries = data_coverage[
-        data_coverage['our_countries']
-    ]['country_earningscalls'].unique().tolist() + ['Iran']
-    # Keep relevant year and countries
-    subdf = data_coverage[data_coverage['year'] == 2019]
-    # Calculate distribution
-    share_marketcap = calculate_distribution(subdf)
+    our_countries = cube['our_countries'] + ['Iran']
+    # Calculate distribution in the relevant year
+    share_marketcap = calculate_distribution(cube, year)
     # Calculate number of firms in our sample
-    nr_of_firms = count_nr_firms(data_coverage)
-    nr_of_firms2019 = count_nr_firms(data_coverage, year=2019)
+    nr_of_firms = count_nr_firms(cube)
+    nr_of_firms_year = count_nr_firms(cube, year=year)
     # Add auxiliary data
     table_1_data = pd.concat(
         [
             share_marketcap,
             nr_of_firms,
-            nr_of_firms2019,
+            nr_of_firms_year,
             worldscope.rename('seg'),
             gdp['share'].rename('shareGDP') 
         ], axis=1
@@ -60,20 +61,17 @@ def prepare_table_1(
 
 
 def count_nr_firms(
-    input_df: pd.DataFrame,
+    cube: dict,
     year: Union[bool, int]=False
 ) -> pd.Series:
-    nr_of_firms = input_df.reset_index()[
-        input_df['_merge_compustat'] != 'right_only'
-    ]
     if year:
-        nr_of_firms = nr_of_firms[nr_of_firms['year'] == year]
-    nr_of_firms = nr_of_firms.groupby(
-        ['gvkey', 'country_earningscalls']
-    ).first().groupby(
-        ['country_earningscalls']
-    ).count()['year'].rename(f'nr_of_firms{year if year else ""}')
-    return nr_of_firms
+        nr_of_firms = cube['nr_of_firms']
+        nr_of_firms = nr_of_firms[
+            nr_of_firms.index.get_level_values('year') == year
+        ].droplevel('year')
+    else:
+        nr_of_firms = cube['nr_of_firms_all']
+    return nr_of_firms.rename(f'nr_of_firms{year if year else ""}')
 
 
 def import_worldscope(
@@ -99,36 +97,40 @@ def import_worldscope(
     return segment_data
 
 
-def calculate_distribution(input_df: pd.DataFrame) -> pd.DataFrame:
-    return input_df[
-        input_df['gvkey'] != '334426'
-        # take out Aramco
-    ].assign(
-        inTR=lambda x: x['country_earningscalls'].notna().astype('int'),
-        withMC=lambda x: x['marketcap_first'].notna().astype('int'),
-        inTRandMC=lambda x: x['inTR'].mul(x['marketcap_first'])
-    ).groupby('country_combined').agg(
-        inTR=('inTR', 'sum'),
-        All=('inTR', 'count'),
-        withMC=('withMC', 'sum'),
-        totMC=('marketcap_first', 'sum'),
-        inTRandMC=('inTRandMC', 'sum')
-    ).assign(
+def calculate_distribution(
+    cube: dict,
+    year: Optional[int] = None,
+    exclude: bool = True
+) -> pd.DataFrame:
+    """Coverage shares by country (and year, if no year is given) from the
+    coverage cube, without the excluded firms (Aramco) unless exclude is
+    False."""
+    coverage = cube['coverage']
+    keep = np.ones(len(coverage), dtype=bool)
+    if exclude:
+        keep &= ~coverage.index.get_level_values('excluded').to_numpy(dtype=bool)
+    if year is not None:
+        keep &= coverage.index.get_level_values('year') == year
+    return coverage[keep].groupby(
+        level='country_combined' if year is not None else ['year','country_combined']
+    ).sum().assign(
         pctTR=lambda x: 100*x['inTR'].div(x['All']),
         pctMC=lambda x: 100*x['withMC'].div(x['All']),
         pctMCandTR=lambda x: 100*x['inTRandMC'].div(x['totMC'])
     )
 
 
-def write_table_1(input_df: pd.DataFrame, output_file: str) -> None:
+def write_table_1(
+    input_df: pd.DataFrame, output_file: str, year: int = 2019
+) -> None:
     with open(output_file, 'w', encoding='utf-8') as of:
         of.write(
             r'& \# of firms & \# of sales link & \% of world GDP ' +
-            r'& \# of firms & \% of 2019 market\\' + '\n'
+            rf'& \# of firms & \% of {year} market\\' + '\n'
         )
         of.write(
             '& (all years) & (any year) & (2019) ' +
-            '& (2019) & capitalization \\\\\\midrule\n'
+            f'& ({year}) & capitalization \\\\\\midrule\n'
         )
         for i, (country, row) in enumerate(input_df.iterrows(), start=1):
             if np.isnan(row['shareGDP']) or row['shareGDP'] == 0:
@@ -271,7 +273,9 @@ def prepare_table_6(input_file: str) -> pd.DataFrame:
     return input_df
 
 
-def write_table_6(input_df: pd.DataFrame, output_file: str):
+def write_table_6(
+    input_df: pd.DataFrame, output_file: str, min_firms: int = TABLE6_MIN_FIRMS
+):
     # to move from iso2 to name
     iso2toname = input_df.reset_index()[
         ['country_iso2','country_name']
@@ -313,7 +317,7 @@ def write_table_6(input_df: pd.DataFrame, output_file: str):
         for cat_nr, cat in enumerate(sources_risk):
             ciso2 = nametoiso2[cat]
             sub_av = input_df.xs(ciso2, level='country_iso2')
-            sub_av = sub_av[sub_av['nr_of_firmsALL']>25]['TransmissionRiskALL']
+            sub_av = sub_av[sub_av['nr_of_firmsALL']>min_firms]['TransmissionRiskALL']
             #sub_av.drop(index=['LU','BM'], inplace=True)
             sub_av = sub_av.loc[[x for x in input_df.index.get_level_values(0).unique() if not x == ciso2 and x in sub_av]]
             sub_av = sub_av.sort_values(ascending=False).head(5)
@@ -409,30 +413,14 @@ def write_table_7(data_df: pd.DataFrame, output_file: str) -> None:
             )
 
 
-def prepare_figure_1(coverage_file: str) -> pd.DataFrame:
+def prepare_figure_1(cube_file: str) -> pd.DataFrame:
     # Load data
-    data_coverage = pd.read_pickle(coverage_file)
-    # Prepare variables
-    overtime = data_coverage.assign(
-        inTR=lambda x: x['country_earningscalls'].notna().astype('int'),
-        withMC=lambda x: x['marketcap_first'].notna().astype('int'),
-        inTRandMC=lambda x: x['inTR'].mul(x['marketcap_first'])
-    ).groupby(['year','country_combined']).agg(
-        inTR=('inTR', 'sum'),
-        All=('inTR', 'count'),
-        withMC=('withMC', 'sum'),
-        totMC=('marketcap_first', 'sum'),
-        inTRandMC=('inTRandMC', 'sum')
-    ).assign(
-        pctTR=lambda x: 100*x['inTR'].div(x['All']),
-        pctMC=lambda x: 100*x['withMC'].div(x['All']),
-        pctMCandTR=lambda x: 100*x['inTRandMC'].div(x['totMC'])
-    )
+    cube = pd.read_pickle(cube_file)
+    # Aggregate all firms by year and country
+    overtime = calculate_distribution(cube, exclude=False)
     # Reshape
     overtime = overtime.reset_index(level=0).loc[
-        overtime.reset_index(level=0).index.isin(
-            data_coverage[data_coverage['our_countries']]['country_earningscalls']
-        )
+        overtime.reset_index(level=0).index.isin(cube['our_countries'])
     ].set_index('year', append=True)
     # Select US and non-US countries
     overtime_us = overtime.xs('United States', level=0)
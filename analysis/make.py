@@ -1,15 +1,16 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
 import os
 from pathlib import Path
 import re
 import shutil
 import subprocess
-from typing import Dict, Iterable, Union
+import sys
+from typing import Dict, Iterable, List, Optional, Union
 
 import yaml
 
-import code.python.helpers as h
-
 # project root
 ROOT = Path(
     os.path.join(
@@ -17,12 +18,20 @@ ROOT = Path(
         '../'
     )
 )
+sys.path.append(ROOT.as_posix())
+
+import code.python.helpers as h  # noqa: E402
+from pipeline.plan import PlannedStep, add_estimates, print_plan  # noqa: E402
+from pipeline.stata import run_stata, set_timeouts  # noqa: E402
+from pipeline.telemetry import StepUsage, Telemetry  # noqa: E402
 
 # config file, input and output folder
 CONFIG_FILE = ROOT.joinpath('config.yaml')
 DATA = ROOT.joinpath('data')
 RAW_DATA = ROOT.joinpath('raw')
 OUTPUT_FOLDER = ROOT.joinpath('analysis/output')
+# Resource usage of earlier runs, kept by --clean_slate
+HISTORY_FILE = ROOT.joinpath('analysis/run_history.jsonl')
 
 
 def check_files_exist(file_dict: Dict[str, str]) -> Dict[str, str]:
@@ -79,51 +88,14 @@ def prepend_files(
             raise NotImplementedError(f'Not implemented: {type(files)}')
     return data_files
 
-if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(
-        description='Creates all tables and figures.'
-    )
-    parser.add_argument('--clean_slate', action='store_true', default=True)
-    parser.add_argument('--also_compile', action='store_true', default=False)
-    args = parser.parse_args()
-
-    # load config yaml
-    with CONFIG_FILE.open('r', encoding='utf-8') as stream:
-        try:
-            config_dict = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-        # add absolute path to files
-        final_data = prepend_files(config_dict['final_data'], DATA, RAW_DATA)
-    
-    # Replace existing output folder with empty folder
-    if args.clean_slate:
-        print('Deleting existing output...')
-        if OUTPUT_FOLDER.joinpath('figures').exists():
-            shutil.rmtree(OUTPUT_FOLDER.joinpath('figures'), ignore_errors=True)
-        if OUTPUT_FOLDER.joinpath('tables').exists():
-            shutil.rmtree(OUTPUT_FOLDER.joinpath('tables'), ignore_errors=True)
-        if OUTPUT_FOLDER.joinpath('../logs').exists():
-            shutil.rmtree(OUTPUT_FOLDER.joinpath('../logs'), ignore_errors=True)
-    if not OUTPUT_FOLDER.joinpath('figures').exists():
-        OUTPUT_FOLDER.joinpath('figures').mkdir()
-    if not OUTPUT_FOLDER.joinpath('tables').exists():
-        OUTPUT_FOLDER.joinpath('tables').mkdir()
-    if not OUTPUT_FOLDER.joinpath('../logs').exists():
-        OUTPUT_FOLDER.joinpath('../logs').mkdir()
-
-    # Check that required files exist
-    check_files_exist(final_data)
-    print('All final data files exist')
-
-    # Change folder so that Stata logs end up in the correct folder
-    os.chdir(ROOT.joinpath('analysis/logs'))
-    
-    # Figure 1
+def figure_1(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 1...')
     # Prepare figure
-    figure_1_data = h.prepare_figure_1(final_data['COVERAGE_FILE'])
+    figure_1_data = h.prepare_figure_1(final_data['COVERAGE_CUBE_FILE'])
     # Plot and save
     figure_1 = h.plot_figure_1(figure_1_data)
     figure_1.savefig(
@@ -132,7 +104,11 @@ if __name__ == '__main__':
         bbox_inches='tight'
     )
 
-    # Figure 2
+
+def figure_2(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 2...')
     # Prepare figure
     figure_2_data = h.prepare_figure_2(final_data['DECOMPOSED_FIN_FILE'])
@@ -148,7 +124,11 @@ if __name__ == '__main__':
         format='eps'
     )
 
-    # Figure 3
+
+def figure_3(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 3...')
     # Prepare figure
     figure_3_data = h.prepare_figure_3(final_data['DECOMPOSED_FIN_FILE'])
@@ -164,7 +144,11 @@ if __name__ == '__main__':
         format='eps'
     )
 
-    # Figure 4
+
+def figure_4(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 4...')
     # Prepare figure
     figure_4_data = h.prepare_figure_4(final_data['DECOMPOSED_HQ_FILE'])
@@ -180,39 +164,43 @@ if __name__ == '__main__':
         format='eps'
     )
 
-    # Figure 5
+
+def figure_5(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 5...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/figure5.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/figure5.do\"',
             final_data['COUNTRYQUARTER_FILE'],
             f'{OUTPUT_FOLDER}/figures/Figure5_risk_timeFE.eps'
-        ],
-        check=False
+        ]
     )
 
-    # Figure 6
+
+def figure_6(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 6...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/figure6.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/figure6.do\"',
             final_data['COUNTRYQUARTER_FILE'],
             f'{OUTPUT_FOLDER}/figures/Figure6_crises_XX.eps',
             f'{DATA}',
             "1" # put =0 if you want to include Appendix Figure 4
-        ],
-        check=False
+        ]
     )
 
-    # Figure 7
+
+def figure_7(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 7...')
     # Prepare figure
     figure_7_data = h.prepare_figure_7(final_data['TRANSMISSIONRISK_TAU_FILE'])
@@ -224,7 +212,11 @@ if __name__ == '__main__':
             figurename, bbox_inches='tight', pad_inches=0, format='eps'
         )
 
-    # Figure 8
+
+def figure_8(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Figure 8...')
     # Prepare figure
     figure_8_data = h.prepare_figure_8(final_data['TRANSMISSIONRISK_TAU_FILE'])
@@ -234,11 +226,16 @@ if __name__ == '__main__':
         figure_8_filename, bbox_inches='tight', pad_inches=0, format='eps'
     )
 
-    # Table 1
+
+def table_1(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 1...')
     # Prepare data
     table_1_data = h.prepare_table_1(
         final_data['COVERAGE_FILE'],
+        final_data['COVERAGE_CUBE_FILE'],
         final_data['WORLDSCOPE_FILE'],
         final_data['GDP_FILE']
     )
@@ -248,7 +245,11 @@ if __name__ == '__main__':
         f'{OUTPUT_FOLDER}/tables/Table1_coverage.tex'
     )
 
-    # Table 2
+
+def table_2(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 2...')
     for file in final_data['TFIDF_FILES']:
         # prepare data
@@ -259,52 +260,56 @@ if __name__ == '__main__':
             f"{OUTPUT_FOLDER}/tables/Table2_top20ngrams_{re.search(r'/([a-z][a-z])_', file)[1]}.tex"
         )
 
-    # Table 3
+
+def table_3(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 3...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table3.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table3.do\"',
             final_data['FIRMCOUNTRY_FILE'],
             f'{OUTPUT_FOLDER}/tables/Table3_firmcountry_pooledreg.tex',
-        ],
-        check=False
+        ]
     )
 
-    # Table 4
+
+def table_4(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 4...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table4.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table4.do\"',
             f'{DATA}',
             f'{OUTPUT_FOLDER}',
-        ],
-        check=False
+        ]
     )
 
-    # Table 5
+
+def table_5(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 5...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table5.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table5.do\"',
             f'{DATA}',
             f'{OUTPUT_FOLDER}',
-        ],
-        check=False
+        ]
     )
 
-    # Table 6
+
+def table_6(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 6...')
     # Prepare data
     table_6_data = h.prepare_table_6(final_data['TRANSMISSIONRISK_FILE'])
@@ -314,21 +319,21 @@ if __name__ == '__main__':
         f'{OUTPUT_FOLDER}/tables/Table6_transmissionriskXXX.tex'
     )
 
-    # Table 7
+
+def table_7(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 7...')
     # Prepare data
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table7_prepare.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table7_prepare.do\"',
             final_data['TRANSMISSIONRISK_TAU_FILE'],
             final_data['TRANSMISSIONRISK_FIRM_TAU_FILE'],
             f'{OUTPUT_FOLDER}/tables/table7_data.dta',
-        ],
-        check=False
+        ]
     )
     # Read and write table
     table_7_data = h.prepare_table_7(f'{OUTPUT_FOLDER}/tables/table7_data.dta')
@@ -337,50 +342,285 @@ if __name__ == '__main__':
         f'{OUTPUT_FOLDER}/tables/Table7_transmissionrisk_overview.tex'
     )
 
-    # Table 8
+
+def table_8(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 8...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table8.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table8.do\"',
             final_data['COUNTRYQUARTER_FILE'],
             f'{OUTPUT_FOLDER}',
-        ],
-        check=False
+        ]
     )
 
-    # Table 9
+
+def table_9(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 9...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table9.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table9.do\"',
             final_data['COUNTRYQUARTER_FILE'],
             f'{OUTPUT_FOLDER}',
-        ],
-        check=False
+        ]
     )
 
-    # Table 10
+
+def table_10(
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str
+) -> None:
     print('Table 10...')
-    subprocess.run(
+    run_stata(
+        stata_exec,
+        ROOT.joinpath('analysis/code/stata/table10.do'),
         [
-            config_dict['general']['stata_exec'],
-            '-q',
-            '-b',
-            'do',
-            f'\"{ROOT}/analysis/code/stata/table10.do\"',
             final_data['COUNTRYQUARTER_FILE'],
             f'{OUTPUT_FOLDER}',
-        ],
-        check=False
+        ]
+    )
+
+
+def target_outputs(name: str) -> List[Path]:
+    """Files that a figure or table wrote in the last run: all of them
+    start with its name, e.g. Table4_PanelA_sustats_FirmCountry.tex."""
+    return sorted(
+        x
+        for folder in ['figures', 'tables']
+        for x in OUTPUT_FOLDER.joinpath(folder).glob(f'{name}_*')
+    )
+
+
+def target_log(log_folder: Path, name: str) -> Path:
+    """Log file of a figure or table. The suffix keeps it apart from the
+    Stata log of its do file (e.g. table3.log), also on case-insensitive
+    file systems."""
+    return log_folder.joinpath(f'{name}_run.log')
+
+
+def run_target(
+        name: str,
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str,
+        log_folder: Path,
+        stata_timeouts: Optional[Dict[str, Optional[float]]] = None
+) -> StepUsage:
+    """Creates one figure or table and writes everything that is printed
+    along the way to its own log file.
+
+    Args:
+        name (str): Key of the figure or table in TARGETS.
+        final_data (Dict[str, Union[str, Iterable[str]]]): Final data files.
+        stata_exec (str): Command that calls Stata.
+        log_folder (Path): Folder for the log file.
+        stata_timeouts (Optional[Dict[str, Optional[float]]]): Time limits
+        of the do files, see pipeline.stata.set_timeouts.
+
+    Returns:
+        StepUsage: Wall time, CPU time, peak memory, and I/O.
+    """
+    # Set in the worker process, which does not share the module state
+    set_timeouts(stata_timeouts)
+    telemetry = Telemetry()
+    with target_log(log_folder, name).open('w', encoding='utf-8') as log, \
+            redirect_stdout(log), redirect_stderr(log):
+        with telemetry.measure(name):
+            TARGETS[name](final_data, stata_exec)
+    return telemetry.records[0]
+
+
+def run_targets(
+        names: List[str],
+        final_data: Dict[str, Union[str, Iterable[str]]],
+        stata_exec: str,
+        log_folder: Path,
+        jobs: int = 1,
+        stata_timeouts: Optional[Dict[str, Optional[float]]] = None
+) -> Dict[str, StepUsage]:
+    """Creates figures and tables, one after another or, if jobs > 1, on
+    a pool of processes. Stops at the first figure or table that fails;
+    those that have not started yet are cancelled.
+
+    Returns:
+        Dict[str, StepUsage]: Resources used by each figure and table.
+    """
+    usage = {}
+    if jobs <= 1:
+        for name in names:
+            print(f'{name}...')
+            try:
+                usage[name] = run_target(
+                    name, final_data, stata_exec, log_folder, stata_timeouts
+                )
+            except Exception:
+                print(f'{name} failed, see {target_log(log_folder, name)}')
+                raise
+        return usage
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(
+                run_target,
+                name,
+                final_data,
+                stata_exec,
+                log_folder,
+                stata_timeouts
+            ): name for name in names
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                usage[name] = future.result()
+            except Exception:
+                print(f'{name} failed, see {target_log(log_folder, name)}')
+                for other in futures:
+                    other.cancel()
+                raise
+            print(f'{name} done')
+    return usage
+
+
+# All figures and tables, in the order of the paper
+TARGETS = {
+    'Figure1': figure_1,
+    'Figure2': figure_2,
+    'Figure3': figure_3,
+    'Figure4': figure_4,
+    'Figure5': figure_5,
+    'Figure6': figure_6,
+    'Figure7': figure_7,
+    'Figure8': figure_8,
+    'Table1': table_1,
+    'Table2': table_2,
+    'Table3': table_3,
+    'Table4': table_4,
+    'Table5': table_5,
+    'Table6': table_6,
+    'Table7': table_7,
+    'Table8': table_8,
+    'Table9': table_9,
+    'Table10': table_10,
+}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Creates all tables and figures.'
+    )
+    parser.add_argument(
+        '--clean_slate',
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help='Delete all figures, tables, and logs first (not with --only); '
+        '--no-clean_slate keeps them.'
+    )
+    parser.add_argument('--also_compile', action='store_true', default=False)
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of figures and tables that are created at the same time.'
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        default=False,
+        help='Only print the figures and tables that would be created, with '
+        'their final data files, the files of their last run, and estimated '
+        'wall time and peak memory.'
+    )
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        choices=list(TARGETS),
+        metavar='TARGET',
+        help='Create only these figures and tables, e.g. Figure7 Table6, and '
+        'keep all other output.'
+    )
+    args = parser.parse_args()
+    targets = args.only if args.only else list(TARGETS)
+
+    # load config yaml
+    with CONFIG_FILE.open('r', encoding='utf-8') as stream:
+        try:
+            config_dict = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+        # add absolute path to files
+        final_data = prepend_files(config_dict['final_data'], DATA, RAW_DATA)
+    
+    # Only show what would be created, with estimates from earlier runs
+    if args.plan:
+        planned = []
+        for target in targets:
+            inputs = []
+            for key in config_dict['targets'][target]:
+                files = final_data[key]
+                inputs.extend(Path(x) for x in ([files] if isinstance(files, str) else files))
+            missing = [x for x in inputs if not x.exists()]
+            # Figures and tables are not tracked like the data steps, so
+            # each one runs again and replaces its files of the last run
+            planned.append(PlannedStep(
+                name=target,
+                status='missing input' if missing else 'always runs',
+                inputs=inputs,
+                outputs=target_outputs(target)
+            ))
+        add_estimates(planned, HISTORY_FILE)
+        print_plan(planned, jobs=args.jobs)
+        sys.exit(0)
+
+    # Replace existing output folder with empty folder
+    if args.clean_slate and not args.only:
+        print('Deleting existing output...')
+        if OUTPUT_FOLDER.joinpath('figures').exists():
+            shutil.rmtree(OUTPUT_FOLDER.joinpath('figures'), ignore_errors=True)
+        if OUTPUT_FOLDER.joinpath('tables').exists():
+            shutil.rmtree(OUTPUT_FOLDER.joinpath('tables'), ignore_errors=True)
+        if OUTPUT_FOLDER.joinpath('../logs').exists():
+            shutil.rmtree(OUTPUT_FOLDER.joinpath('../logs'), ignore_errors=True)
+    if not OUTPUT_FOLDER.joinpath('figures').exists():
+        OUTPUT_FOLDER.joinpath('figures').mkdir()
+    if not OUTPUT_FOLDER.joinpath('tables').exists():
+        OUTPUT_FOLDER.joinpath('tables').mkdir()
+    if not OUTPUT_FOLDER.joinpath('../logs').exists():
+        OUTPUT_FOLDER.joinpath('../logs').mkdir()
+
+    # Check that required files exist
+    check_files_exist({
+        key: final_data[key]
+        for target in targets for key in config_dict['targets'][target]
+    })
+    print('All final data files exist')
+
+    # Change folder so that Stata logs end up in the correct folder
+    os.chdir(ROOT.joinpath('analysis/logs'))
+    
+    # Create all (or the selected) figures and tables
+    usage = run_targets(
+        targets,
+        final_data,
+        config_dict['general']['stata_exec'],
+        ROOT.joinpath('analysis/logs'),
+        jobs=args.jobs,
+        stata_timeouts=config_dict.get('stata_timeouts')
     )
+    telemetry = Telemetry()
+    print('Wall time (seconds):')
+    for name in targets:
+        print(f'{name:>8}: {usage[name].wall_seconds:8.1f}')
+        telemetry.add(usage[name])
+    report = telemetry.write_report(ROOT.joinpath('analysis/logs'), 'analysis')
+    telemetry.append_history(HISTORY_FILE)
+    print(f'Run report: {report}')
 
     # Compile tex file
     if args.also_compile:
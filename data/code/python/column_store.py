@@ -0,0 +1,148 @@
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+META_FILE = 'meta.json'
+
+
+def write_store(
+    data: pd.DataFrame,
+    folder: Path,
+    meta: Optional[dict] = None,
+    derived: Optional[Dict[str, Tuple[str, Dict[str, str]]]] = None,
+) -> None:
+    """Writes a data frame as a column store: one .npy file per column,
+    which can be memory-mapped and read individually. String and
+    categorical columns are stored as integer codes plus their categories.
+    The folder is replaced atomically.
+
+    Args:
+        data (pd.DataFrame): Data to store. The index is not stored.
+        folder (Path): Folder of the store.
+        meta (Optional[dict]): Further information kept in meta.json.
+        derived (Optional[Dict[str, Tuple[str, Dict[str, str]]]]): Columns
+        that are not stored but looked up when read, as name: (string
+        column, mapping of its values). Values without mapping are missing.
+    """
+    folder = Path(folder)
+    tmp_folder = folder.with_name(folder.name + '.tmp')
+    if tmp_folder.exists():
+        shutil.rmtree(tmp_folder)
+    tmp_folder.mkdir(parents=True)
+    columns = {}
+    for i, (name, values) in enumerate(data.items()):
+        file_name = f'{i}.npy'
+        if values.dtype == object or isinstance(
+            values.dtype, (pd.CategoricalDtype, pd.StringDtype)
+        ):
+            categorical = pd.Categorical(values)
+            codes = categorical.codes
+            np.save(tmp_folder.joinpath(file_name), codes)
+            columns[name] = {
+                'file': file_name,
+                'categories': categorical.categories.tolist(),
+                'categorical': isinstance(values.dtype, pd.CategoricalDtype),
+            }
+        else:
+            np.save(tmp_folder.joinpath(file_name), values.to_numpy())
+            columns[name] = {'file': file_name}
+    for name, (source, mapping) in (derived or {}).items():
+        if 'categories' not in columns[source]:
+            raise ValueError(f'Column {source} is not a string column.')
+        columns[name] = {
+            'derived_from': source,
+            'categories': columns[source]['categories'],
+            'mapping': mapping,
+            'categorical': False,
+        }
+    with tmp_folder.joinpath(META_FILE).open('w', encoding='utf-8') as outfile:
+        json.dump(
+            {'nrows': len(data), 'columns': columns, **(meta or {})},
+            outfile,
+            default=str,
+        )
+    if folder.exists():
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+
+def source_signature(file: Path) -> dict:
+    """Identifies the version of a file by its path, size, and
+    modification time, e.g. to tell whether a store is outdated."""
+    stat = Path(file).stat()
+    return {
+        'path': Path(file).resolve().as_posix(),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+
+
+def read_meta(folder: Path) -> dict:
+    with Path(folder).joinpath(META_FILE).open('r', encoding='utf-8') as infile:
+        return json.load(infile)
+
+
+def read_store(
+    folder: Path,
+    columns: Optional[Iterable[str]] = None,
+    mmap: bool = True,
+    as_categorical: bool = False,
+    rows: Optional[slice] = None,
+) -> pd.DataFrame:
+    """Reads (some of the) columns of a column store.
+
+    Args:
+        folder (Path): Folder of the store.
+        columns (Optional[Iterable[str]]): Columns to read; all if None.
+        mmap (bool): Memory-map the column files instead of reading them.
+        as_categorical (bool): Return string columns as categoricals
+        instead of objects (categorical columns are always categorical).
+        rows (Optional[slice]): Rows to read; all if None. With mmap, only
+        these rows are loaded into memory.
+
+    Returns:
+        pd.DataFrame: The columns, in the requested order.
+    """
+    folder = Path(folder)
+    meta = read_meta(folder)
+    if columns is None:
+        columns = list(meta['columns'])
+    missing = [x for x in columns if x not in meta['columns']]
+    if missing:
+        raise ValueError(f'Columns not in {folder}: {", ".join(missing)}')
+    data = {}
+    for name in columns:
+        info = meta['columns'][name]
+        file_name = meta['columns'][info.get('derived_from', name)]['file']
+        values = np.load(
+            folder.joinpath(file_name), mmap_mode='r' if mmap else None
+        )
+        if rows is not None:
+            values = values[rows]
+        if 'mapping' in info:
+            # Look up the few categories, not every row; the extra last
+            # entry is picked by the code -1 of missing values
+            lookup = np.array(
+                [info['mapping'].get(x, np.nan) for x in info['categories']]
+                + [np.nan],
+                dtype=object,
+            )
+            mapped = lookup[np.asarray(values)]
+            data[name] = pd.Categorical(mapped) if as_categorical else mapped
+        elif 'categories' in info:
+            categorical = pd.Categorical.from_codes(
+                np.asarray(values), categories=info['categories']
+            )
+            if info['categorical'] or as_categorical:
+                data[name] = categorical
+            else:
+                data[name] = np.asarray(categorical, dtype=object)
+        else:
+            data[name] = values
+    return pd.DataFrame(data, copy=False)
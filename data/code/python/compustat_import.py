@@ -1,16 +1,63 @@
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
+)
+from contextlib import nullcontext
+import multiprocessing
 from pathlib import Path
-from typing import Iterable
+import re
+import shutil
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+from code.python.column_store import (
+    read_meta, read_store, source_signature, write_store
+)
 
-def create_marketcap(stock_data: pd.DataFrame, only_exclude_adr: bool=False) -> pd.DataFrame:
-    if only_exclude_adr:
-        return stock_data[
-            stock_data['iid'].str.extract(r'(\d+)')[0].astype('int') < 90
-        ]
+# Folder (in the output folder) with one subfolder per year, e.g.
+# year=2019, that holds the market cap (marketcap) and the market cap
+# merged with the company information (merged) as column stores
+PARTITIONS_FOLDER = 'compustat_marketcap'
+# Column store of the company information
+COMPANY_FOLDER = 'compustat_company'
+# Column stores of the raw security files, converted once from the pickles
+SECURITIES_FOLDER = 'compustat_secd'
+# Columns of the security files used for the market cap
+SECURITY_COLUMNS = [
+    'gvkey', 'iid', 'datadate', 'prccd', 'exchange_rate_toUSD', 'cshoc', 'marketcap'
+]
+# Rows of the security files read at a time, unless set otherwise
+BATCH_ROWS = 5_000_000
+
+# Lock shared by the workers of import_compustat_marketcap, set once in
+# each worker process
+_shared: Dict[str, Any] = {}
+
+
+def issue_numbers(iid: pd.Series) -> np.ndarray:
+    """Returns the number in each issue ID (e.g. 1 for '01W'). The regex
+    runs once per distinct issue ID, not once per row.
+
+    Args:
+        iid (pd.Series): Issue IDs, as strings or categorical.
+
+    Raises:
+        ValueError: Raised if an issue ID is missing or has no number.
+    """
+    categorical = pd.Categorical(iid)
+    if (categorical.codes < 0).any():
+        raise ValueError('Missing issue ID (iid).')
+    numbers = pd.Series(categorical.categories).str.extract(r'(\d+)')[0]
+    return numbers.astype('int').to_numpy()[categorical.codes]
+
+
+def filter_securities(stock_data: pd.DataFrame) -> pd.DataFrame:
+    """Keeps the December data of issues that are not ADRs."""
+    # Few distinct issue IDs: keep them as categorical (sorted like strings)
     stock_data = stock_data.assign(
-        datadate=lambda v: pd.to_datetime(v['datadate'])
+        datadate=lambda v: pd.to_datetime(v['datadate']),
+        iid=lambda v: v['iid'].astype('category')
     )
     # Keep December (and later restrict to last available data point in December)
     stock_data = stock_data[
@@ -18,80 +65,345 @@ def create_marketcap(stock_data: pd.DataFrame, only_exclude_adr: bool=False) ->
     ]
     # Exclude ADR: "If the 2-digit numeric component is 90 or above, the security is an American Depository Receipt (ADR)."
     # from https://wrds-www.wharton.upenn.edu/data-dictionary/form_metadata/comp_na_daily_all_secd_dataitems/IID/
-    stock_data = stock_data[
-        stock_data['iid'].str.extract(r'(\d+)')[0].astype('int') < 90
-    ]
-    # Aggregate all issues to company level
-    marketcap_sum = stock_data.groupby(
-        ['gvkey','datadate']
-    )['marketcap'].sum()
-    marketcap_median = stock_data.sort_values(
-        by=['gvkey','iid','datadate']
-    ).groupby(
-        ['gvkey','datadate']
-    )['marketcap'].median()
-    marketcap_first = stock_data.sort_values(
-        by=['gvkey','iid','datadate']
+    return stock_data[issue_numbers(stock_data['iid']) < 90]
+
+
+def aggregate_marketcap(stock_data: pd.DataFrame) -> pd.DataFrame:
+    """Aggregates filtered security data to the last date of each firm."""
+    # Aggregate all issues to company level in one grouped pass: sorted by
+    # issue within firm-date, 'first' takes the first issue with data
+    marketcap = stock_data.assign(
+        iid=lambda v: v['iid'].astype('category')
+    ).sort_values(
+        by=['gvkey','datadate','iid']
     ).groupby(
         ['gvkey','datadate']
-    )[['prccd','exchange_rate_toUSD','cshoc','marketcap']].first()
-    marketcap = pd.concat([
-        marketcap_sum.rename('marketcap_sum'),
-        marketcap_median.rename('marketcap_median'),
-        marketcap_first.rename(columns={'marketcap':'marketcap_first'})
-    ], axis=1)
-    marketcap = marketcap.reset_index()
-    # Restrict to last date of each firm in December
-    marketcap = marketcap.sort_values(
-        by=['gvkey','datadate'],
-        na_position='first'
-    ).groupby(['gvkey']).last().reset_index()
+    ).agg(
+        marketcap_sum=('marketcap', 'sum'),
+        marketcap_median=('marketcap', 'median'),
+        prccd=('prccd', 'first'),
+        exchange_rate_toUSD=('exchange_rate_toUSD', 'first'),
+        cshoc=('cshoc', 'first'),
+        marketcap_first=('marketcap', 'first'),
+    )
+    # Restrict to last date of each firm in December (the groups are
+    # sorted by date; 'last' takes the last date with data, by column)
+    marketcap = marketcap.reset_index().groupby(['gvkey']).last().reset_index()
     # Potential problem: Not all iids are available on each day.
     return marketcap
 
 
-def import_compustat_marketcap(input_files: Iterable[Path]) -> pd.DataFrame:
-    all_files = []
-    for year in range(2002, 2021):
-        print(f'Importing market cap for year {year}...')
-        # load
-        g_marketcap = create_marketcap(
-            pd.read_pickle(
-                [x for x in input_files if x.match(
-                    f'*/g_secd_dec{year}_marketcap.pkl'
-                )][0]
+def create_marketcap(stock_data: pd.DataFrame, only_exclude_adr: bool=False) -> pd.DataFrame:
+    if only_exclude_adr:
+        return stock_data[issue_numbers(stock_data['iid']) < 90]
+    return aggregate_marketcap(filter_securities(stock_data))
+
+
+# Columns of which the market cap of a firm takes the last date with data
+VALUE_COLUMNS = ['marketcap', 'prccd', 'exchange_rate_toUSD', 'cshoc']
+
+
+def drop_superseded_dates(stock_data: pd.DataFrame) -> pd.DataFrame:
+    """Drops the rows of firm-dates before the last date on which a firm
+    has data in all of VALUE_COLUMNS. These dates cannot be the last date
+    with data of any column, whatever other rows are added later."""
+    complete = stock_data[VALUE_COLUMNS].notna().groupby(
+        [stock_data['gvkey'], stock_data['datadate']]
+    ).transform('any').all(axis=1)
+    last_complete = stock_data['datadate'].where(complete).groupby(
+        stock_data['gvkey']
+    ).transform('max')
+    return stock_data[~(stock_data['datadate'] < last_complete)]
+
+
+def create_marketcap_batched(batches: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Same as create_marketcap, for security data that is read in batches,
+    e.g. daily data of whole years that does not fit into memory. Each
+    batch is filtered right away, and of the rows so far only those of
+    firm-dates that may still be the last date with data of a firm are
+    kept, so memory is bounded by the batch size and the number of firms.
+
+    Args:
+        batches (Iterable[pd.DataFrame]): Security data, in any order; at
+        least one batch.
+    """
+    kept = None
+    for batch in batches:
+        batch = filter_securities(batch)
+        if kept is not None:
+            batch = pd.concat([kept, batch], ignore_index=True)
+        kept = drop_superseded_dates(batch)
+    return aggregate_marketcap(kept)
+
+
+def marketcap_files(input_files: Iterable[Path], year: int) -> Tuple[Path, Path]:
+    """Returns the Global and the North America security file of a year."""
+    g_file = [
+        x for x in input_files if x.match(f'*/g_secd_dec{year}_marketcap.pkl')
+    ][0]
+    na_file = [
+        x for x in input_files if x.match(f'*/na/na_secd_dec{year}_marketcap.pkl')
+    ][0]
+    return g_file, na_file
+
+
+def marketcap_years(input_files: Iterable[Path]) -> List[int]:
+    """Returns the years for which there are Global security files."""
+    years = [
+        re.fullmatch(r'g_secd_dec(\d{4})_marketcap\.pkl', Path(x).name)
+        for x in input_files
+    ]
+    return sorted(int(x.group(1)) for x in years if x is not None)
+
+
+def securities_store(input_file: Path, output_folder: Path) -> Path:
+    """Returns the column store of a security file. The pickle is
+    converted the first time, so that later imports (e.g. after changes of
+    the code) only map the columns the market cap needs.
+
+    A pickle cannot be read in parts, so the conversion is the one time a
+    whole security file is in memory. The workers of
+    import_compustat_marketcap convert one file at a time, so that the
+    first import needs memory for the largest file plus the batches of the
+    other years; all later reads are batches of the store.
+    """
+    folder = Path(output_folder).joinpath(SECURITIES_FOLDER, Path(input_file).stem)
+    try:
+        is_valid = read_meta(folder).get('source') == source_signature(input_file)
+    except FileNotFoundError:
+        is_valid = False
+    if not is_valid:
+        with _shared.get('conversion_lock') or nullcontext():
+            write_store(
+                pd.read_pickle(input_file),
+                folder,
+                meta={'source': source_signature(input_file)}
             )
+    return folder
+
+
+def read_securities(input_file: Path, output_folder: Path) -> pd.DataFrame:
+    """Reads the columns of a security file that the market cap needs."""
+    return read_store(
+        securities_store(input_file, output_folder), columns=SECURITY_COLUMNS
+    )
+
+
+def iter_securities(
+    input_file: Path, output_folder: Path, batch_rows: int
+) -> Iterator[pd.DataFrame]:
+    """Like read_securities, but yields batches of at most batch_rows rows;
+    only the rows of a batch are loaded from the column store."""
+    folder = securities_store(input_file, output_folder)
+    nrows = read_meta(folder)['nrows']
+    # An empty file still gives one (empty) batch
+    for start in range(0, max(nrows, 1), batch_rows):
+        yield read_store(
+            folder,
+            columns=SECURITY_COLUMNS,
+            rows=slice(start, start + batch_rows)
         )
-        na_marketcap = create_marketcap(
-            pd.read_pickle(
-                [x for x in input_files if x.match(
-                    f'*/na/na_secd_dec{year}_marketcap.pkl'
-                )][0]
-            )
+
+
+def import_compustat_marketcap_year(
+    input_files: Iterable[Path],
+    year: int,
+    output_folder: Path,
+    batch_rows: Optional[int] = BATCH_ROWS
+) -> pd.DataFrame:
+    print(f'Importing market cap for year {year}...')
+    g_file, na_file = marketcap_files(input_files, year)
+    # load (in batches of batch_rows rows, if given)
+    if batch_rows:
+        g_marketcap = create_marketcap_batched(
+            iter_securities(g_file, output_folder, batch_rows)
         )
-        # combine (Compustat NA takes precedence)
-        g_marketcap_sub = g_marketcap[
-            ~g_marketcap['gvkey'].isin(set(na_marketcap['gvkey'].values))
-        ]
-        marketcap = pd.concat(
-            [na_marketcap, g_marketcap_sub], ignore_index=True
-        ).assign(
-            year=year
+        na_marketcap = create_marketcap_batched(
+            iter_securities(na_file, output_folder, batch_rows)
         )
-        marketcap = marketcap[marketcap['datadate'].dt.year == year]
-        all_files.append(marketcap)
-    return pd.concat(all_files).drop_duplicates()
+    else:
+        g_marketcap = create_marketcap(read_securities(g_file, output_folder))
+        na_marketcap = create_marketcap(read_securities(na_file, output_folder))
+    # combine (Compustat NA takes precedence)
+    g_marketcap_sub = g_marketcap[
+        ~g_marketcap['gvkey'].isin(set(na_marketcap['gvkey'].values))
+    ]
+    marketcap = pd.concat(
+        [na_marketcap, g_marketcap_sub], ignore_index=True
+    ).assign(
+        year=year
+    )
+    return marketcap[marketcap['datadate'].dt.year == year]
+
+
+def company_files(input_files: Iterable[Path]) -> List[Path]:
+    """Returns the Global and the North America company file."""
+    return [
+        [x for x in input_files if x.match('global/g_company.pkl')][0],
+        [x for x in input_files if x.match('na/na_company.pkl')][0],
+    ]
+
+
+def partition_sources(input_files: Iterable[Path], year: int) -> dict:
+    """Signatures of the files a partition is built from, including this
+    module, so that changes of the code rebuild the partitions."""
+    return {
+        'year': year,
+        'files': [
+            source_signature(x)
+            for x in [
+                *marketcap_files(input_files, year),
+                *company_files(input_files),
+                Path(__file__),
+            ]
+        ],
+    }
+
+
+def is_partition_valid(
+    input_files: Iterable[Path], output_folder: Path, year: int
+) -> bool:
+    partition = Path(output_folder).joinpath(PARTITIONS_FOLDER, f'year={year}')
+    try:
+        meta = read_meta(partition.joinpath('merged'))
+    except FileNotFoundError:
+        return False
+    return meta.get('sources') == partition_sources(input_files, year)
+
+
+def append_year(
+    input_files: Iterable[Path],
+    output_folder: Path,
+    year: int,
+    batch_rows: Optional[int] = BATCH_ROWS
+) -> None:
+    """Imports the market cap of one year and merges it with the company
+    information in the company store (see import_compustat). Both are
+    stored in the partition of the year, which replaces an existing one;
+    the other years are not touched.
+
+    Args:
+        input_files (Iterable[Path]): Compustat files; only the security
+        files of the year are read.
+        output_folder (Path): Folder with the company store and the
+        partitions.
+        year (int): Year of the partition.
+        batch_rows (Optional[int]): Rows of the security files read at a
+        time (BATCH_ROWS by default); all at once if None.
+    """
+    input_files = list(input_files)
+    partition = Path(output_folder).joinpath(PARTITIONS_FOLDER, f'year={year}')
+    marketcap = import_compustat_marketcap_year(
+        input_files, year, output_folder, batch_rows
+    ).drop_duplicates()
+    merged = merge_compustat(
+        marketcap, read_store(Path(output_folder).joinpath(COMPANY_FOLDER))
+    )
+    meta = {'sources': partition_sources(input_files, year)}
+    write_store(marketcap, partition.joinpath('marketcap'), meta=meta)
+    # Written last, as its meta data marks the partition as complete
+    write_store(merged, partition.joinpath('merged'), meta=meta)
+
+
+def read_partitions(
+    output_folder: Path,
+    name: str,
+    columns: Optional[Iterable[str]] = None,
+    years: Optional[Iterable[int]] = None
+) -> pd.DataFrame:
+    """Reads the market cap ('marketcap') or the merged data ('merged') of
+    all (or some) years, in the order of the years.
+
+    Args:
+        output_folder (Path): Folder with the partitions.
+        name (str): 'marketcap' or 'merged'.
+        columns (Optional[Iterable[str]]): Columns to read; all if None.
+        years (Optional[Iterable[int]]): Years to read; all if None.
+    """
+    folder = Path(output_folder).joinpath(PARTITIONS_FOLDER)
+    if years is None:
+        years = sorted(int(x.name[5:]) for x in folder.glob('year=*'))
+    return pd.concat(
+        [
+            read_store(folder.joinpath(f'year={year}', name), columns=columns)
+            for year in years
+        ],
+        ignore_index=True
+    )
+
+
+def _set_shared(conversion_lock: Any) -> None:
+    _shared.update(conversion_lock=conversion_lock)
+
+
+def import_compustat_marketcap(
+    input_files: Iterable[Path],
+    output_folder: Path,
+    jobs: int = 1,
+    years_in_flight: Optional[int] = None,
+    batch_rows: Optional[int] = BATCH_ROWS
+) -> None:
+    """Updates the partitions of all years whose input files changed and
+    removes those of years without input files. The years are independent,
+    so with jobs > 1 they are imported on a pool of processes.
+
+    Args:
+        input_files (Iterable[Path]): Compustat files.
+        output_folder (Path): Folder with compustat_company.pkl and the
+        partitions.
+        jobs (int): Number of processes.
+        years_in_flight (Optional[int]): Maximum number of years that are
+        submitted but not yet done, which bounds the daily data held in
+        memory; defaults to jobs.
+        batch_rows (Optional[int]): Rows of the security files read at a
+        time (BATCH_ROWS by default); all at once if None.
+    """
+    input_files = list(input_files)
+    years = marketcap_years(input_files)
+    folder = Path(output_folder).joinpath(PARTITIONS_FOLDER)
+    for partition in folder.glob('year=*'):
+        if int(partition.name[5:]) not in years:
+            shutil.rmtree(partition)
+    stale = [
+        x for x in years if not is_partition_valid(input_files, output_folder, x)
+    ]
+    for year in sorted(set(years) - set(stale)):
+        print(f'Market cap for year {year} is up to date...')
+    if jobs <= 1:
+        for year in stale:
+            append_year(input_files, output_folder, year, batch_rows)
+        return None
+    years_in_flight = max(years_in_flight or jobs, 1)
+    # This runs in a thread of the build, next to other threads, so the
+    # workers must not be forked from this process
+    context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=context,
+        initializer=_set_shared,
+        initargs=(context.Lock(),)
+    ) as executor:
+        running: Dict[Future, int] = {}
+        for year in stale:
+            if len(running) >= years_in_flight:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    running.pop(future)
+                    future.result()
+            running[executor.submit(
+                append_year, input_files, output_folder, year, batch_rows
+            )] = year
+        for future in as_completed(running):
+            future.result()
+    return None
 
 
 def import_compustat_company(input_files: Iterable[Path]) -> pd.DataFrame:
+    g_file, na_file = company_files(input_files)
     # global company file
-    g_company = pd.read_pickle(
-        [x for x in input_files if x.match('global/g_company.pkl')][0]
-    )
+    g_company = pd.read_pickle(g_file)
     # na company file
-    na_company = pd.read_pickle(
-        [x for x in input_files if x.match('na/na_company.pkl')][0]
-    )
+    na_company = pd.read_pickle(na_file)
     # combine
     company = pd.concat(
         [
@@ -104,13 +416,7 @@ def import_compustat_company(input_files: Iterable[Path]) -> pd.DataFrame:
     return company
 
 
-def merge_compustat(
-    marketcap_file: str,
-    names_file: str
-) -> pd.DataFrame:
-    print('Merge all Compustat...')
-    marketcap = pd.read_pickle(marketcap_file)
-    names = pd.read_pickle(names_file)
+def merge_compustat(marketcap: pd.DataFrame, names: pd.DataFrame) -> pd.DataFrame:
     # merge with SIC information
     merged = marketcap.merge(
         names,
@@ -130,17 +436,43 @@ def merge_compustat(
     return merged
 
 
-def import_compustat(input_files: Iterable[Path], output_folder: str) -> None:
-    # Output files
-    marketcap_file = f'{output_folder}/compustat_marketcap.pkl'
-    company_file = f'{output_folder}/compustat_company.pkl'
-    compustat_file = f'{output_folder}/compustat_merged.pkl'
-    # Import Compustat market capitalization
-    marketcap = import_compustat_marketcap(input_files)
-    marketcap.to_pickle(marketcap_file)
+def import_compustat(
+    input_files: Iterable[Path],
+    output_folder: str,
+    jobs: int = 1,
+    years_in_flight: Optional[int] = None,
+    batch_rows: Optional[int] = BATCH_ROWS
+) -> None:
+    """Imports the Compustat company information and the market cap of all
+    years into column stores in the output folder: compustat_company and
+    one partition per year in compustat_marketcap (see read_partitions).
+    Only what changed since the last import is imported again.
+
+    Args:
+        input_files (Iterable[Path]): Compustat files.
+        output_folder (str): Folder of the column stores.
+        jobs (int): Number of processes that import years.
+        years_in_flight (Optional[int]): Maximum number of years in memory.
+        batch_rows (Optional[int]): Rows of the security files read at a
+        time, which bounds the memory per year (BATCH_ROWS by default);
+        all at once if None.
+    """
+    input_files = list(input_files)
     # Import Compustat SIC sectors
-    names = import_compustat_company(input_files)
-    names.to_pickle(company_file)
-    # Merge (and remove ETFs)
-    merged = merge_compustat(marketcap_file, company_file)
-    merged.to_pickle(compustat_file)
\ No newline at end of file
+    company_folder = Path(output_folder).joinpath(COMPANY_FOLDER)
+    sources = [source_signature(x) for x in company_files(input_files)]
+    try:
+        is_valid = read_meta(company_folder).get('sources') == sources
+    except FileNotFoundError:
+        is_valid = False
+    if not is_valid:
+        write_store(
+            import_compustat_company(input_files),
+            company_folder,
+            meta={'sources': sources}
+        )
+    # Import Compustat market capitalization by year and merge (and
+    # remove ETFs); only years whose files changed are imported again
+    import_compustat_marketcap(
+        input_files, output_folder, jobs, years_in_flight, batch_rows
+    )
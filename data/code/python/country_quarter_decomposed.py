@@ -2,13 +2,16 @@ from pathlib import Path
 
 import pandas as pd
 
+from code.python.scores_cache import read_scores
+
+
 def create_decomposed_country_quarter(
-    scores_file: Path, output_file: str
+    scores_cache: Path, output_file: str
 ) -> None:
     print('Create decomposed country-quarter data...')
     # Load firm-country-quarter data
-    scores = pd.read_stata(
-        scores_file,
+    scores = read_scores(
+        scores_cache,
         columns=['gvkey','country_iso2','sic','dateQ', 'risk', 'loc_iso2']
     )
     # Standard deviation for later
@@ -0,0 +1,168 @@
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from code.python.scores_cache import read_scores
+
+# Scores averaged by country-quarter
+SCORE_COLUMNS = ['exposure', 'risk', 'sentiment']
+
+# Sets of firms (K): each marks the firm-country-quarters in the sample;
+# all others form the sample 'NOT: <name>'. A new set only needs a mask.
+SAMPLES: Dict[str, Callable[[pd.DataFrame], np.ndarray]] = {
+    # Any firm
+    'all': lambda x: np.ones(len(x), dtype=bool),
+    # Firms with HQ
+    'hq': lambda x: (x['country_iso2'] == x['loc_iso2']).to_numpy(),
+    # Financial firms
+    'financial': lambda x: pd.to_numeric(x['sic'], errors='coerce').between(
+        6000, 6800, inclusive='left'
+    ).to_numpy(),
+    # US firms
+    'us': lambda x: (x['loc_iso2'] == 'US').to_numpy(),
+}
+
+
+# Weighting schemes of Appendix Table 11, by suffix: the column with the
+# weight of a firm (None: equal weights) and the value of 'big' of the
+# firms that are kept (None: all firms)
+WEIGHTS: Dict[str, Tuple[Optional[str], Optional[int]]] = {
+    '_at': ('at', None),
+    '_lat': ('lat', None),
+    '_bc': ('at_bc', None),
+    '_small': (None, 0),
+    '_large': (None, 1),
+}
+
+
+def aggregate_samples(
+    scores: pd.DataFrame,
+    samples: Dict[str, Callable[[pd.DataFrame], np.ndarray]] = SAMPLES,
+    weights: Iterable[str] = ('',)
+) -> Dict[str, pd.DataFrame]:
+    """Aggregates the scores by country-quarter for each sample and its
+    complement, and counts the firms (nroffirms) and the firms with HQ in
+    the country (nrofhqfirms) they are based on. The country-quarters are
+    grouped once; each sample and weighting scheme only adds a few
+    bincounts.
+
+    Unweighted ('') scores are means. Weighted scores follow
+    country_quarter.do: each firm's weight is divided by the total weight
+    of its country-quarter-sample, and the weighted scores are summed
+    (missing scores and weights are left out, so the sum is 0 if all are
+    missing).
+
+    Args:
+        scores (pd.DataFrame): Firm-country-quarter scores with
+        country_iso2, dateQ, the scores, and the columns the samples and
+        the weights use.
+        samples (Dict[str, Callable[[pd.DataFrame], np.ndarray]]): Masks
+        of the samples, by name.
+        weights (Iterable[str]): '' (unweighted) and/or keys of WEIGHTS.
+
+    Returns:
+        Dict[str, pd.DataFrame]: By weight, scores and counts by
+        country_iso2, dateQ, and sample (data: '<name>' or 'NOT: <name>'),
+        sorted by these, without empty samples (like 'NOT: all').
+    """
+    grouped = scores.groupby(['country_iso2','dateQ'], sort=True, dropna=False)
+    group = grouped.ngroup().to_numpy()
+    keys = grouped.size().index.to_frame(index=False)
+    keys = keys.loc[keys.index.repeat(2)].reset_index(drop=True)
+    nr_of_cells = len(keys)
+    hq = (scores['country_iso2'] == scores['loc_iso2']).to_numpy()
+    values = {
+        x: scores[x].to_numpy(dtype=float) for x in SCORE_COLUMNS
+    }
+    # Cell 2g + 1 holds the sample of country-quarter g, 2g the others
+    cells = {
+        name: 2 * group + mask(scores).astype(int)
+        for name, mask in samples.items()
+    }
+    aggregated = {}
+    for weight in weights:
+        if weight:
+            column, big = WEIGHTS[weight]
+            keep = (
+                np.ones(len(scores), dtype=bool) if big is None
+                else scores['big'].to_numpy(dtype=float) == big
+            )
+            touse = np.where(
+                keep,
+                1.0 if column is None else scores[column].to_numpy(dtype=float),
+                np.nan
+            )
+        else:
+            keep = np.ones(len(scores), dtype=bool)
+        frames = []
+        for name, cell in cells.items():
+            nroffirms = np.bincount(
+                cell, weights=keep, minlength=nr_of_cells
+            ).astype(int)
+            result = {}
+            if weight:
+                total = np.bincount(
+                    cell, weights=np.nan_to_num(touse), minlength=nr_of_cells
+                )[cell]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    share = np.where(total != 0, touse / total, np.nan)
+            for x in SCORE_COLUMNS:
+                if weight:
+                    weighted = share * values[x]
+                    result[x] = np.bincount(
+                        cell,
+                        weights=np.where(np.isnan(weighted), 0, weighted),
+                        minlength=nr_of_cells
+                    )
+                    continue
+                valid = ~np.isnan(values[x])
+                total = np.bincount(
+                    cell, weights=np.where(valid, values[x], 0), minlength=nr_of_cells
+                )
+                count = np.bincount(cell, weights=valid, minlength=nr_of_cells)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result[x] = np.where(count > 0, total / count, np.nan)
+            result['nroffirms'] = nroffirms
+            result['nrofhqfirms'] = np.bincount(
+                cell, weights=hq & keep, minlength=nr_of_cells
+            ).astype(int)
+            result = pd.DataFrame(result).assign(
+                data=np.tile([f'NOT: {name}', name], nr_of_cells // 2)
+            )
+            frames.append(pd.concat([keys, result], axis=1)[nroffirms > 0])
+        aggregated[weight] = pd.concat(frames, ignore_index=True).sort_values(
+            ['country_iso2','dateQ','data'], ignore_index=True
+        )
+    return aggregated
+
+
+def samples_file(output_file: Path, weight: str = '') -> Path:
+    """File of the samples with a weighting scheme, e.g.
+    country_quarter_samples_at.dta for '_at'."""
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.stem + weight + output_file.suffix)
+
+
+def create_country_quarter_samples(
+    scores_cache: Path, output_file: Path, weights: Iterable[str] = ()
+) -> None:
+    """Saves the country-quarter scores of all samples (see
+    aggregate_samples) as .dta for country_quarter.do, unweighted in the
+    output file and with each of the weighting schemes in weights (for
+    Appendix Table 11) next to it (see samples_file)."""
+    print('Create country-quarter data by sample...')
+    weights = ['', *weights]
+    columns = ['country_iso2','dateQ','loc_iso2','sic', *SCORE_COLUMNS]
+    for weight in weights[1:]:
+        column, _ = WEIGHTS[weight]
+        columns.append('big' if column is None else column)
+    scores = read_scores(scores_cache, columns=list(dict.fromkeys(columns)))
+    for weight, aggregated in aggregate_samples(scores, weights=weights).items():
+        aggregated.to_stata(
+            samples_file(output_file, weight),
+            write_index=False,
+            convert_dates={'dateQ': 'tq'}
+        )
+    return None
@@ -1,80 +1,121 @@
 import json
 import os
 from pathlib import Path
-import re
-from typing import Iterable, Optional
+import threading
+from typing import Dict, Iterable, Optional, Tuple
 
+import numpy as np
 import pandas as pd  # type: ignore
 
 
-def import_countryidentifiers(
-    input_files: Iterable[Path], output_folder: Path, return_files: bool = False
-) -> Optional[dict[str, pd.DataFrame]]:
-    print("Import country identifiers...")
-    # Save each as dta for Stata import
-    colnames = {"iso3.json": "iso3", "names.json": "country_name"}
-    toreturn: dict[str, pd.DataFrame] = {}
-    for file in input_files:
-        colname = colnames[file.name]
-        with file.open("r", encoding="utf-8") as infile:
-            data = json.load(infile)
-        data = (
-            pd.DataFrame.from_dict(data, orient="index")
-            .reset_index()
-            .rename(columns={"index": "iso2", 0: colname})
+# Country names of the World Bank that differ from our naming
+NAME_ALIASES = {
+    "Egypt, Arab Rep.": "Egypt",
+    "Hong Kong SAR, China": "Hong Kong",
+    "Russian Federation": "Russia",
+    "Korea, Rep.": "South Korea",
+    "Virgin Islands (U.S.)": "U.S. Virgin Islands",
+    "Turkiye": "Turkey",
+    "Iran, Islamic Rep.": "Iran",
+}
+
+
+class CountryIdentifiers:
+    """Crosswalk between country ISO-2 codes, ISO-3 codes, and country
+    names, with a dense integer code per ISO-2 code for joins.
+
+    Attributes:
+        iso2_iso3 (pd.DataFrame): ISO-2 (iso2) and ISO-3 (iso3) codes, as
+        in iso3.json.
+        iso2_names (pd.DataFrame): ISO-2 codes (iso2) and country names
+        (country_name), as in names.json.
+        table (pd.DataFrame): All ISO-2 codes with their ISO-3 code, name,
+        and integer code (code), sorted by ISO-2 code.
+        aliases (Dict[str, str]): Other names of countries (e.g., of the
+        World Bank) and our name for them.
+    """
+
+    def __init__(
+        self,
+        iso2_iso3: pd.DataFrame,
+        iso2_names: pd.DataFrame,
+        aliases: Optional[Dict[str, str]] = None,
+    ):
+        self.iso2_iso3 = iso2_iso3
+        self.iso2_names = iso2_names
+        self.aliases = dict(NAME_ALIASES if aliases is None else aliases)
+        self.table = (
+            iso2_iso3.merge(iso2_names, on="iso2", how="outer", validate="1:1")
+            .sort_values("iso2", ignore_index=True)
+            .assign(code=lambda x: np.arange(len(x), dtype=np.int32))
         )
-        if not return_files:
+
+    @classmethod
+    def from_json(cls, input_files: Iterable[Path]) -> "CountryIdentifiers":
+        colnames = {"iso3.json": "iso3", "names.json": "country_name"}
+        frames = {}
+        for file in input_files:
+            colname = colnames[Path(file).name]
+            with Path(file).open("r", encoding="utf-8") as infile:
+                data = json.load(infile)
+            frames[colname] = (
+                pd.DataFrame.from_dict(data, orient="index")
+                .reset_index()
+                .rename(columns={"index": "iso2", 0: colname})
+            )
+        return cls(frames["iso3"], frames["country_name"])
+
+    def encode(self, values: pd.Series, by: str = "iso2") -> np.ndarray:
+        """Integer codes of ISO-2 codes, ISO-3 codes, or country names
+        (by='iso2', 'iso3', or 'country_name'); -1 if unknown."""
+        lookup = self.table.dropna(subset=[by])
+        position = pd.Index(lookup[by]).get_indexer(values)
+        codes = lookup["code"].to_numpy()[position]
+        return np.where(position >= 0, codes, -1).astype(np.int32)
+
+    def decode(self, codes: np.ndarray, to: str = "country_name") -> np.ndarray:
+        """ISO-2 codes, ISO-3 codes, or country names of integer codes;
+        missing for -1."""
+        lookup = np.append(self.table[to].to_numpy(dtype=object), np.nan)
+        return lookup[np.asarray(codes)]
+
+    def normalize_names(self, names: pd.Series) -> pd.Series:
+        """Replaces other names of countries by our names."""
+        return names.apply(lambda v: self.aliases[v] if v in self.aliases else v)
+
+    def to_stata(self, output_folder: Path) -> None:
+        """Saves iso2_iso3.dta and iso2_names.dta for the Stata steps."""
+        for colname, data in [("iso3", self.iso2_iso3), ("names", self.iso2_names)]:
             data.to_stata(
-                os.path.join(
-                    output_folder, re.sub(r"\.json", ".dta", f"iso2_{file.name}")
-                ),
+                os.path.join(output_folder, f"iso2_{colname}.dta"),
                 write_index=False,
             )
-        else:
-            toreturn[f"iso2_{file.name}"] = data
-    if return_files:
-        return toreturn
-    return None
 
 
-def add_countrynames(input_file: Path, countrynames: pd.DataFrame) -> None:
-    """This function checks if there is a column named 'country_name' in
-    the file with CountryRisk. If not, it presumes that the 'loc_cname' is
-    also not present, that there is a country ISO-2 for the country of the
-    CountryRisk measure and the firms' headquarter, and merges in the
-    country names.
+_loaded: Dict[Tuple[Path, ...], CountryIdentifiers] = {}
+_lock = threading.Lock()
+
 
-    The purpose of this all is to have a consistent set of country names.
+def load_countryidentifiers(input_files: Iterable[Path]) -> CountryIdentifiers:
+    """Returns the country identifiers of iso3.json and names.json. They
+    are read only once per run; later calls return the same object.
 
     Args:
-        input_file (Path): File with CountryRisk measures.
-        countrynames (pd.DataFrame): DataFrame with two columns: the
-        country ISO-2 code and the country name.
+        input_files (Iterable[Path]): The JSON files iso3.json and
+        names.json.
+
+    Returns:
+        CountryIdentifiers: The crosswalk.
     """
-    print("Checking that country names are in country risk score file...")
-    try:
-        scores = pd.read_stata(
-            input_file,
-            columns=["country_name"],
-        )
-    except ValueError:
-        print("Adding country names...")
-        scores = (
-            pd.read_stata(input_file)
-            .merge(
-                countrynames,
-                left_on="loc_iso2",
-                right_on="iso2",
-                how="left",
-            )
-            .drop(columns=["iso2"])
-            .rename(columns={"country_name": "loc_cname"})
-            .merge(
-                countrynames,
-                left_on="country_iso2",
-                right_on="iso2",
-                how="left",
-            )
-            .drop(columns=["iso2"])
-        )
-        scores.to_stata(input_file, convert_dates={"dateQ": "tq"}, write_index=False)
+    key = tuple(Path(x).resolve() for x in input_files)
+    with _lock:
+        if key not in _loaded:
+            _loaded[key] = CountryIdentifiers.from_json(key)
+        return _loaded[key]
+
+
+def import_countryidentifiers(input_files: Iterable[Path], output_folder: Path) -> None:
+    print("Import country identifiers...")
+    # Save each as dta for Stata import
+    load_countryidentifiers(input_files).to_stata(output_folder)
+    return None
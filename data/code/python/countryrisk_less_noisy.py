@@ -0,0 +1,81 @@
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from code.python.column_store import read_store, write_store
+from code.python.scores_cache import read_scores
+from pipeline.hdfe import residualize
+
+# Columns of the scores kept in the firm-country-quarter data
+FIRMCOUNTRYQUARTER_COLUMNS = [
+    'gvkey', 'country_iso2', 'country_name', 'dateQ', 'loc_iso2', 'sic',
+    'risk', 'exposure', 'company_name'
+]
+
+
+def countryrisk_less_noisy(scores: pd.DataFrame) -> pd.DataFrame:
+    """Adds CountryRisk_less_noisy = Exposure_ict * tilde(CountryRisk_ct).
+
+    tilde(CountryRisk_ct) (risk_resid) is the mean risk that foreign firms
+    perceive in country c in quarter t, net of country and quarter fixed
+    effects, plus the mean over all country-quarters. The country-quarters
+    are coded once; the means are grouped sums over these codes, and each
+    firm-country-quarter looks up its residual by its code.
+
+    Args:
+        scores (pd.DataFrame): Firm-country-quarter scores.
+
+    Returns:
+        pd.DataFrame: The scores with risk_resid and CountryRisk_less_noisy.
+    """
+    grouped = scores.groupby(['country_iso2','dateQ'], sort=True, dropna=False)
+    cell = grouped.ngroup().to_numpy()
+    collapsed = grouped.size().index.to_frame(index=False)
+    # Keep perceptions by foreign firms and take average
+    risk = scores['risk'].to_numpy(dtype=float)
+    foreign = (
+        (scores['country_iso2'] != scores['loc_iso2']).to_numpy() & ~np.isnan(risk)
+    )
+    total = np.bincount(
+        cell, weights=np.where(foreign, risk, 0), minlength=len(collapsed)
+    )
+    count = np.bincount(cell, weights=foreign, minlength=len(collapsed))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        collapsed['risk'] = np.where(count > 0, total / count, np.nan)
+    # Residualize on country and quarter fixed effects and add mean back
+    risk_resid = residualize(
+        collapsed, 'risk', ['country_iso2','dateQ']
+    ).to_numpy() + collapsed['risk'].mean()
+    return scores.assign(
+        risk_resid=risk_resid[cell],
+        CountryRisk_less_noisy=lambda x: x['exposure'] * x['risk_resid'],
+    )
+
+
+def create_countryrisk_less_noisy(
+    scores_cache: Path, output_folder: Path, output_file: Path
+) -> None:
+    """Saves the firm-country-quarter data with CountryRisk_less_noisy as a
+    column store, and as .dta for the transmission risk do files.
+
+    Args:
+        scores_cache (Path): Column store of the scores.
+        output_folder (Path): Folder of the column store.
+        output_file (Path): The .dta file.
+    """
+    print('Define CountryRisk_ict (less noisy)...')
+    scores = countryrisk_less_noisy(
+        read_scores(scores_cache, columns=FIRMCOUNTRYQUARTER_COLUMNS)
+    )
+    write_store(scores, output_folder)
+    scores.to_stata(output_file, write_index=False, convert_dates={'dateQ': 'tq'})
+    return None
+
+
+def read_firmcountryquarter(
+    folder: Path, columns: Optional[Iterable[str]] = None
+) -> pd.DataFrame:
+    """Reads columns of the firm-country-quarter data from its column store."""
+    return read_store(folder, columns=columns)
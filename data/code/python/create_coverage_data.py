@@ -1,12 +1,21 @@
 from pathlib import Path
+from typing import Dict
 
+import numpy as np
 import pandas as pd
 
+from code.python.compustat_import import read_partitions
+from code.python.countryidentifiers_import import CountryIdentifiers
+from code.python.dictionary_encoding import (
+    KeyDictionary, combine_keys, outer_join
+)
+from code.python.scores_cache import read_scores
 
-def import_our_sample(input_file: Path, output_file: Path) -> None:
+
+def import_our_sample(scores_cache: Path, output_file: Path) -> None:
     print('Creating firm-year file of our sample...')
-    scores = pd.read_stata(
-        input_file,
+    scores = read_scores(
+        scores_cache,
         columns=['gvkey','country_name','loc_iso2','loc_cname','dateQ']
     )
     our_countries = scores['country_name'].unique().tolist()
@@ -26,48 +35,91 @@ def import_our_sample(input_file: Path, output_file: Path) -> None:
     collapsed.to_pickle(output_file)
 
 
+# Columns of the merged Compustat data that the coverage data needs
+COMPUSTAT_COLUMNS = ['gvkey', 'year', 'marketcap_first', 'loc', 'sic', 'naics']
+
+# Categories of the merge indicators, as of pandas' merge(indicator=True)
+MERGE_CATEGORIES = ['left_only', 'right_only', 'both']
+
+
 def create_coverage_data(
-    compustat_file: Path,
-    iso2toname_file: Path,
-    iso2toiso3_file: Path,
+    compustat_folder: Path,
+    countries: CountryIdentifiers,
     oursample_file: Path,
-    output_file: str
+    output_file: str,
+    cube_file: str
 ) -> None:
+    """Merges the Compustat firm-years with the firm-years of our sample
+    and saves the coverage data and its cube (see create_coverage_cube).
+
+    Countries are joined by their code in the shared crosswalk. The gvkey
+    ids, unlike the country codes, are built for this merge only, from the
+    gvkeys of both sides, and are not shared with other steps.
+
+    Args:
+        compustat_folder (Path): Folder with the Compustat partitions.
+        countries (CountryIdentifiers): The country crosswalk.
+        oursample_file (Path): Firm-years of our sample (import_our_sample).
+        output_file (str): Pickle of the coverage data.
+        cube_file (str): Pickle of the cube.
+    """
     print('Creating coverage data set...')
     # Load all data
-    compustat = pd.read_pickle(compustat_file)
-    iso2toname = pd.read_stata(iso2toname_file)
-    iso2toiso3 = pd.read_stata(iso2toiso3_file)
+    compustat = read_partitions(
+        compustat_folder, 'merged', columns=COMPUSTAT_COLUMNS
+    )
     our_sample = pd.read_pickle(oursample_file)
-    # add country name that is consistent with our data
-    compustat = compustat.merge(
-        iso2toname.merge(
-            iso2toiso3,
-            on='iso2',
-            validate='1:1'
+    # Join on integer ids instead of strings: countries by their code in
+    # the crosswalk, firm-years by a combined key of gvkey id (of this
+    # merge) and year
+    codes = countries.encode(compustat['loc'], by='iso3')
+    named = countries.table['country_name'].notna().to_numpy()
+    # Keep Compustat firms in countries with ISO-2 code and name
+    keep = codes >= 0
+    keep[keep] = named[codes[keep]]
+    codes = codes[keep]
+    compustat = compustat[keep].reset_index(drop=True).assign(
+        iso2=countries.decode(codes, to='iso2'),
+        country_compustat=countries.decode(codes, to='country_name'),
+        iso3=countries.decode(codes, to='iso3'),
+        _merge_iso2tonames=pd.Categorical.from_codes(
+            np.full(len(codes), 2, dtype=np.int8), categories=MERGE_CATEGORIES
         ),
-        left_on='loc',
-        right_on='iso3',
-        validate='m:1',
-        indicator=True
-    )
-    compustat = compustat.rename(
-        columns={
-            '_merge':'_merge_iso2tonames',
-            'country_name':'country_compustat'
-        }
     )
     # merge with our sample
-    merged = our_sample.merge(
-        compustat,
-        on=['gvkey','year'],
-        how='outer',
-        validate='1:1',
-        indicator=True
+    our_sample = our_sample.reset_index()
+    firms = KeyDictionary(our_sample['gvkey'], compustat['gvkey'])
+    years = np.concatenate([our_sample['year'], compustat['year']])
+    first_year = int(years.min()) if len(years) else 0
+    nr_years = int(years.max()) - first_year + 1 if len(years) else 1
+    keys, left_rows, right_rows = outer_join(*[
+        combine_keys(
+            firms.encode(x['gvkey']), x['year'], first_year, nr_years
+        )
+        for x in [our_sample, compustat]
+    ])
+    merged = pd.concat(
+        [
+            pd.DataFrame({
+                'gvkey': pd.Series(
+                    firms.decode(keys // nr_years),
+                    dtype=our_sample['gvkey'].dtype
+                ),
+                'year': keys % nr_years + first_year,
+            }),
+            our_sample.drop(columns=['gvkey','year']).reindex(left_rows)
+            .reset_index(drop=True),
+            compustat.drop(columns=['gvkey','year']).reindex(right_rows)
+            .reset_index(drop=True),
+        ],
+        axis=1
+    )
+    merged['_merge_compustat'] = pd.Categorical.from_codes(
+        np.where(left_rows < 0, 1, np.where(right_rows < 0, 0, 2)),
+        categories=MERGE_CATEGORIES
     )
     merged = merged.rename(
         columns={
-            '_merge':'_merge_compustat',
             'loc_cname':'country_earningscalls',
             'loc_iso2':'countryiso2_earningscalls',
         }
@@ -91,4 +143,54 @@ def create_coverage_data(
         )
     )
     merged.to_pickle(output_file)
-    return None
\ No newline at end of file
+    pd.to_pickle(create_coverage_cube(merged), cube_file)
+    return None
+
+
+# Firms left out of the market cap shares of Table 1 (Aramco)
+EXCLUDED_FIRMS = ['334426']
+
+
+def create_coverage_cube(coverage: pd.DataFrame) -> Dict[str, object]:
+    """Aggregates the firm-year coverage data by year and country, so that
+    Table 1 (of any year) and Figure 1 only slice and sum the aggregates.
+
+    Args:
+        coverage (pd.DataFrame): Coverage data of create_coverage_data().
+
+    Returns:
+        Dict[str, object]: 'coverage': firms in our sample (inTR), all
+        firms (All), firms with market cap (withMC), market cap (totMC),
+        and market cap of firms in our sample (inTRandMC) by year,
+        country_combined, and whether the firm is in EXCLUDED_FIRMS
+        (excluded); 'nr_of_firms': distinct firms of our sample by year
+        and country_earningscalls; 'nr_of_firms_all': the same over all
+        years, by country_earningscalls; 'our_countries': the countries
+        of our sample.
+    """
+    cube = coverage.assign(
+        excluded=lambda x: x['gvkey'].isin(EXCLUDED_FIRMS),
+        inTR=lambda x: x['country_earningscalls'].notna().astype('int'),
+        withMC=lambda x: x['marketcap_first'].notna().astype('int'),
+        inTRandMC=lambda x: x['inTR'].mul(x['marketcap_first'])
+    ).groupby(['year','country_combined','excluded']).agg(
+        inTR=('inTR', 'sum'),
+        All=('inTR', 'count'),
+        withMC=('withMC', 'sum'),
+        totMC=('marketcap_first', 'sum'),
+        inTRandMC=('inTRandMC', 'sum')
+    )
+    firms = coverage.loc[
+        coverage['_merge_compustat'] != 'right_only',
+        ['gvkey','year','country_earningscalls']
+    ]
+    return {
+        'coverage': cube,
+        'nr_of_firms': firms.groupby(
+            ['year','country_earningscalls']
+        )['gvkey'].nunique(),
+        'nr_of_firms_all': firms.groupby('country_earningscalls')['gvkey'].nunique(),
+        'our_countries': coverage[
+            coverage['our_countries']
+        ]['country_earningscalls'].unique().tolist(),
+    }
\ No newline at end of file
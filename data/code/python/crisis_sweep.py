@@ -0,0 +1,245 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import multiprocessing
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from code.python.column_store import read_store
+from code.python.countryrisk_less_noisy import read_firmcountryquarter
+from code.python.define_crises import (
+    GLOBAL_THRESHOLD, SD_GLOBAL, define_crises, number_crises
+)
+from code.python.transmissionrisk import (
+    FIRM_TYPES, MIN_FIRMS, origin_destination_tau, read_origin_destination_quarter
+)
+from pipeline.paper import TABLE6_MIN_FIRMS
+
+# Parameters of the sweep and their values in the paper
+DEFAULTS = {
+    'sd_global': SD_GLOBAL,
+    'global_threshold': GLOBAL_THRESHOLD,
+    'min_firms': MIN_FIRMS,
+    'table6_min_firms': TABLE6_MIN_FIRMS,
+}
+
+# Intermediates shared by all settings, set once in each worker process
+_shared: Dict[str, pd.DataFrame] = {}
+
+
+def origin_destination_firms(firmcountryquarter: pd.DataFrame) -> pd.DataFrame:
+    """Counts the distinct foreign firms by origin and destination
+    (nr_of_firmsALL of transmissionrisk_OriginDestination.do)."""
+    data = firmcountryquarter[
+        firmcountryquarter['country_iso2'] != firmcountryquarter['loc_iso2']
+    ]
+    first = ~data.duplicated(['gvkey','country_iso2'])
+    return data[first].groupby(
+        ['country_iso2','loc_iso2'], sort=True
+    ).size().rename('nr_of_firmsALL').reset_index()
+
+
+def crisis_regressions(tau: pd.DataFrame) -> pd.DataFrame:
+    """Estimates the regressions of Table 7 (columns 1-3) for each crisis
+    and pooled, like table7_prepare.do: TransmissionRisk on an intercept
+    and mTREXCL by type of firms (no common constant), weighted by
+    nr_of_firms (aweights). Crises with fewer than 5 observations are
+    skipped; the pooled sample is always estimated. As in the do file,
+    the pooled sample (crisis_id != 0) includes the rows outside of
+    crises, whose crisis_id is missing.
+
+    Args:
+        tau (pd.DataFrame): Output of origin_destination_tau.
+
+    Returns:
+        pd.DataFrame: crisis (<country>_<nr> or pooled), type, alpha,
+        alpha_se, beta, beta_se, the p-value of beta = 1 (beta_pval), and N.
+    """
+    samples = [
+        (f'{x["country_iso2"].iloc[0]}_{x["crisis_nr"].iloc[0]}', x)
+        for _, x in tau[tau['crisis_id'].notna()].groupby('crisis_id', sort=True)
+    ]
+    samples.append(('pooled', tau))
+    results = []
+    for crisis, sample in samples:
+        if crisis != 'pooled' and sample['TransmissionRisk'].notna().sum() < 5:
+            continue
+        sample = sample[
+            sample[['TransmissionRisk','mTREXCL','nr_of_firms']].notna().all(axis=1)
+            & (sample['nr_of_firms'] > 0)
+        ]
+        types = [x for x in FIRM_TYPES if (sample['type'] == x).any()]
+        indicators = np.column_stack([(sample['type'] == x).to_numpy() for x in types])
+        slopes = indicators * sample['mTREXCL'].to_numpy()[:, None]
+        regressors = np.column_stack([indicators, slopes]).astype(float)
+        y = sample['TransmissionRisk'].to_numpy()
+        # Analytic weights are normalized to sum to the number of observations
+        weights = sample['nr_of_firms'].to_numpy()
+        weights = weights * len(weights) / weights.sum()
+        weighted = regressors * weights[:, None]
+        bread = np.linalg.pinv(regressors.T @ weighted)
+        beta = bread @ (weighted.T @ y)
+        residuals = y - regressors @ beta
+        df_r = len(y) - np.linalg.matrix_rank(regressors)
+        # Without residual degrees of freedom, the standard errors are missing
+        se = np.full(len(beta), np.nan)
+        if df_r > 0:
+            se = np.sqrt(np.diag(bread) * (weights * residuals ** 2).sum() / df_r)
+        for i, firm_type in enumerate(types):
+            j = len(types) + i
+            results.append({
+                'crisis': crisis,
+                'type': firm_type,
+                'alpha': beta[i],
+                'alpha_se': se[i],
+                'beta': beta[j],
+                'beta_se': se[j],
+                # P-value testing that beta != 1
+                'beta_pval': 2 * stats.t.sf(abs(beta[j] - 1) / se[j], df_r),
+                'N': len(y),
+            })
+    return pd.DataFrame(
+        results,
+        columns=[
+            'crisis', 'type', 'alpha', 'alpha_se', 'beta', 'beta_se', 'beta_pval', 'N'
+        ]
+    )
+
+
+def evaluate_setting(
+    setting: Dict[str, float],
+    variables: pd.DataFrame,
+    od_quarter: pd.DataFrame,
+    od_firms: pd.DataFrame,
+) -> pd.DataFrame:
+    """Evaluates one setting of the thresholds on the shared intermediates.
+
+    Args:
+        setting (Dict[str, float]): Value of each parameter in DEFAULTS.
+        variables (pd.DataFrame): Output of crises_variables.
+        od_quarter (pd.DataFrame): Output of origin_destination_quarter.
+        od_firms (pd.DataFrame): Output of origin_destination_firms.
+
+    Returns:
+        pd.DataFrame: Tidy results with the parameters, statistic, crisis,
+        type, and value. The crisis counts are those of crises.csv (all
+        quarters, local quarters, countries with crises, countries with
+        local crises, local crises), of the crises in the tau data (tau),
+        and the origin-destination pairs of Table 6 (table6_pairs); the
+        Table 7 estimates are by crisis and type.
+    """
+    crises = define_crises(
+        variables,
+        sd_global=setting['sd_global'],
+        global_threshold=setting['global_threshold'],
+    )
+    local = number_crises(crises[crises['nolocal'] == 'no'])
+    tau = origin_destination_tau(od_quarter, crises, min_firms=setting['min_firms'])
+    # Destinations among the origins, as in prepare_table_6
+    table6 = od_firms[od_firms['loc_iso2'].isin(od_firms['country_iso2'])]
+    counts = {
+        'crisis_quarters': len(crises),
+        'local_crisis_quarters': len(local),
+        'countries_with_crises': crises['country_iso2'].nunique(),
+        'countries_with_local_crises': local['country_iso2'].nunique(),
+        'local_crises': len(local[['country_iso2','crisis_id']].drop_duplicates()),
+        'tau_crises': tau['crisis_id'].nunique(),
+        'table6_pairs': int((table6['nr_of_firmsALL'] > setting['table6_min_firms']).sum()),
+    }
+    results = [
+        pd.DataFrame({'statistic': list(counts), 'value': list(counts.values())})
+    ]
+    regressions = crisis_regressions(tau)
+    for statistic in ['alpha', 'alpha_se', 'beta', 'beta_se', 'beta_pval', 'N']:
+        results.append(
+            regressions[['crisis','type']].assign(
+                statistic=statistic, value=regressions[statistic]
+            )
+        )
+    results = pd.concat(results, ignore_index=True)
+    for name in reversed(list(DEFAULTS)):
+        results.insert(0, name, setting[name])
+    return results[[*DEFAULTS, 'statistic', 'crisis', 'type', 'value']]
+
+
+def _set_shared(
+    variables: pd.DataFrame, od_quarter: pd.DataFrame, od_firms: pd.DataFrame
+) -> None:
+    _shared.update(variables=variables, od_quarter=od_quarter, od_firms=od_firms)
+
+
+def _evaluate_shared(setting: Dict[str, float]) -> pd.DataFrame:
+    return evaluate_setting(setting, **_shared)
+
+
+def grid_settings(grid: Optional[Dict[str, Iterable[float]]] = None) -> List[Dict[str, float]]:
+    """All combinations of the values in grid; parameters that are not in
+    grid keep their value in DEFAULTS.
+
+    Raises:
+        ValueError: Raised if a parameter is unknown.
+    """
+    grid = dict(grid or {})
+    unknown = set(grid) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f'Unknown parameters: {", ".join(sorted(unknown))}')
+    values = [list(grid.get(name) or [default]) for name, default in DEFAULTS.items()]
+    return [dict(zip(DEFAULTS, x)) for x in product(*values)]
+
+
+def crisis_sweep(
+    variables_folder: Path,
+    od_quarter_folder: Path,
+    firmcountryquarter_folder: Path,
+    output_file: Path,
+    grid: Optional[Dict[str, Iterable[float]]] = None,
+    jobs: int = 1,
+) -> pd.DataFrame:
+    """Evaluates all settings of the crisis thresholds in grid (see
+    grid_settings) on the cached crises variables and
+    origin-destination-quarter data, and saves the tidy results (see
+    evaluate_setting) as csv. The settings are independent, so with
+    jobs > 1 they are evaluated on a pool of processes, each of which
+    receives the intermediates once.
+
+    Args:
+        variables_folder (Path): Column store of the crises variables.
+        od_quarter_folder (Path): Column store of the
+        origin-destination-quarter data.
+        firmcountryquarter_folder (Path): Column store of the
+        firm-country-quarter data.
+        output_file (Path): The csv file.
+        grid (Optional[Dict[str, Iterable[float]]]): Values of the
+        parameters in DEFAULTS.
+        jobs (int): Number of processes.
+
+    Returns:
+        pd.DataFrame: The results.
+    """
+    settings = grid_settings(grid)
+    print(f'Sweep {len(settings)} settings of the crisis thresholds...')
+    shared = (
+        read_store(variables_folder),
+        read_origin_destination_quarter(od_quarter_folder),
+        origin_destination_firms(read_firmcountryquarter(
+            firmcountryquarter_folder, columns=['gvkey','country_iso2','loc_iso2']
+        )),
+    )
+    if jobs <= 1:
+        results = [evaluate_setting(x, *shared) for x in settings]
+    else:
+        # This runs after the threads of the build, so the workers must not
+        # be forked from this process
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=_set_shared,
+            initargs=shared
+        ) as executor:
+            results = list(executor.map(_evaluate_shared, settings))
+    results = pd.concat(results, ignore_index=True)
+    results.to_csv(output_file, index=False)
+    return results
@@ -0,0 +1,221 @@
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from code.python.column_store import read_store, write_store
+from code.python.scores_cache import read_scores
+from pipeline.hdfe import residualize
+
+# Countries whose crises are written, as in define_crises.do
+CRISIS_COUNTRIES = [
+    'China', 'Turkey', 'Greece', 'United States', 'Brazil', 'United Kingdom',
+    'Russia', 'Ireland', 'Spain', 'Thailand', 'Egypt', 'Hong Kong', 'Japan',
+    'Italy', 'Iran', 'Mexico', 'Nigeria', 'Norway', 'Poland', 'Venezuela',
+]
+
+# Threshold of the normalized risk residual (which has sd 2 after
+# normalization, so the threshold is two standard deviations)
+SD_GLOBAL = 2
+
+# Threshold of the standardized global risk for a global crisis
+GLOBAL_THRESHOLD = 2
+
+# Local (non-global) crises set by hand, by country: they replace the
+# ones found in the data
+MANUAL_LOCAL_CRISES: Dict[str, List[pd.Timestamp]] = {
+    'IR': [pd.Timestamp('2012-01-01')],
+}
+
+# Crisis integers set by hand (crises_integers.do): the outbreak of Covid
+# in China, and Brazil's 2016q1-2, as only 2015q4 is missing in between
+MANUAL_CRISIS_IDS: Dict[str, Dict[pd.Timestamp, int]] = {
+    'CN': {pd.Timestamp('2020-01-01'): 4},
+    'BR': {pd.Timestamp('2016-01-01'): 2, pd.Timestamp('2016-04-01'): 2},
+}
+
+
+def _standardize(values: pd.Series, dates: pd.Series) -> pd.Series:
+    """Standardizes with the mean and sd of the quarters before 2020."""
+    before = values[dates.dt.year < 2020]
+    return (values - before.mean()) / before.std()
+
+
+def crises_variables(scores: pd.DataFrame) -> pd.DataFrame:
+    """Collapses risk by country-quarter and computes the variables of
+    crises_variables.do that do not depend on the thresholds.
+
+    globalrisk is the mean risk of all countries in a quarter,
+    standardized with the quarters before 2020. risk_resid is the risk net
+    of country fixed effects (missing for singleton countries), divided by
+    its sd before 2020.
+
+    Args:
+        scores (pd.DataFrame): Firm-country-quarter scores with
+        country_iso2, country_name, dateQ, and risk.
+
+    Returns:
+        pd.DataFrame: country_iso2, country_name, dateQ, risk, globalrisk,
+        and risk_resid, sorted by country_name and dateQ.
+    """
+    collapsed = scores.groupby(
+        ['country_iso2','dateQ'], sort=True, dropna=False
+    )['risk'].mean().reset_index()
+    names = scores.drop_duplicates('country_iso2').set_index('country_iso2')
+    collapsed['country_name'] = (
+        collapsed['country_iso2'].map(names['country_name']).fillna('')
+    )
+    # Identify global crises
+    globalrisk = collapsed.groupby('dateQ')['risk'].mean().reset_index()
+    globalrisk['globalrisk'] = _standardize(globalrisk['risk'], globalrisk['dateQ'])
+    collapsed = collapsed.merge(
+        globalrisk[['dateQ','globalrisk']], on='dateQ', how='left'
+    )
+    # Risk residual after taking out country FE (egen group leaves
+    # empty codes out)
+    country_id = collapsed['country_iso2'].where(collapsed['country_iso2'] != '')
+    risk_resid = residualize(
+        collapsed.assign(country_id=country_id), 'risk', ['country_id']
+    )
+    # Normalize by the panel SD
+    collapsed['risk_resid'] = risk_resid / risk_resid[
+        collapsed['dateQ'].dt.year < 2020
+    ].std()
+    return collapsed.sort_values(
+        ['country_name','dateQ'], kind='stable', ignore_index=True
+    )[['country_iso2','country_name','dateQ','risk','globalrisk','risk_resid']]
+
+
+def define_crises(
+    variables: pd.DataFrame,
+    sd_global: float = SD_GLOBAL,
+    global_threshold: float = GLOBAL_THRESHOLD,
+    countries: Iterable[str] = CRISIS_COUNTRIES,
+) -> pd.DataFrame:
+    """Flags the crises of all countries at once, like define_crises.do.
+
+    A crisis is a quarter whose risk_resid exceeds sd_global; it is global
+    if globalrisk exceeds global_threshold. As in Stata, missing values
+    exceed any threshold. Countries with local (non-global) crises keep
+    only these (nolocal 'no'); countries with only global crises keep all
+    of them (nolocal 'yes'); countries without crises are left out.
+
+    Args:
+        variables (pd.DataFrame): Output of crises_variables.
+        sd_global (float): Threshold of risk_resid.
+        global_threshold (float): Threshold of globalrisk.
+        countries (Iterable[str]): Names of the countries to keep.
+
+    Returns:
+        pd.DataFrame: country_iso2, dateQ, and nolocal, sorted by country
+        name and dateQ.
+    """
+    variables = variables[
+        variables['country_name'].isin(list(countries)) & variables['dateQ'].notna()
+    ]
+    risk_resid = variables['risk_resid'].to_numpy(dtype=float)
+    globalrisk = variables['globalrisk'].to_numpy(dtype=float)
+    crisis = np.isnan(risk_resid) | (risk_resid > sd_global)
+    is_global = np.isnan(globalrisk) | (globalrisk > global_threshold)
+    crises = variables.loc[crisis, ['country_name','country_iso2','dateQ']]
+    local = variables.loc[crisis & ~is_global, ['country_name','country_iso2','dateQ']]
+    # Manual intervention (e.g. Iran), only for countries with any crisis
+    manual = crises.drop_duplicates('country_iso2')
+    manual = manual[manual['country_iso2'].isin(list(MANUAL_LOCAL_CRISES))]
+    local = pd.concat([
+        local[~local['country_iso2'].isin(manual['country_iso2'])],
+        manual.assign(
+            dateQ=manual['country_iso2'].map(MANUAL_LOCAL_CRISES)
+        ).explode('dateQ').astype({'dateQ': crises['dateQ'].dtype}),
+    ])
+    # Countries without local crises keep their global ones
+    crises = pd.concat([
+        crises[~crises['country_iso2'].isin(local['country_iso2'])].assign(nolocal='yes'),
+        local.assign(nolocal='no'),
+    ])
+    return crises.sort_values(
+        ['country_name','dateQ'], kind='stable', ignore_index=True
+    )[['country_iso2','dateQ','nolocal']]
+
+
+def format_quarter(dates: pd.Series) -> pd.Series:
+    """Formats dates like Stata's %tq, e.g. 2012q1."""
+    return dates.dt.year.astype(str) + 'q' + dates.dt.quarter.astype(str)
+
+
+def write_crises(crises: pd.DataFrame, output_file: Path) -> None:
+    """Writes the crises as country_iso2,dateQ,nolocal with %tq quarters."""
+    crises.assign(dateQ=format_quarter(crises['dateQ'])).to_csv(
+        output_file, index=False
+    )
+    return None
+
+
+def read_crises(crises_file: Path) -> pd.DataFrame:
+    """Reads the crises written by write_crises, with dateQ as dates."""
+    crises = pd.read_csv(crises_file)
+    crises['dateQ'] = pd.PeriodIndex(crises['dateQ'], freq='Q').to_timestamp()
+    return crises
+
+
+def number_crises(crises: pd.DataFrame) -> pd.DataFrame:
+    """Gives each crisis within a country an integer (crisis_id), like
+    crises_integers.do: consecutive quarters belong to the same crisis,
+    and the crises are numbered from 1 in order of time.
+
+    Args:
+        crises (pd.DataFrame): Crises with country_iso2 and dateQ.
+
+    Raises:
+        ValueError: Raised if a country-quarter appears more than once.
+
+    Returns:
+        pd.DataFrame: The crises with crisis_id, sorted by country_iso2
+        and dateQ.
+    """
+    if crises.duplicated(['country_iso2','dateQ']).any():
+        raise ValueError('Crises are not unique by country_iso2 and dateQ.')
+    crises = crises.sort_values(['country_iso2','dateQ'], ignore_index=True)
+    quarter = crises['dateQ'].dt.year * 4 + crises['dateQ'].dt.quarter
+    start = (
+        crises['country_iso2'].ne(crises['country_iso2'].shift())
+        | quarter.ne(quarter.shift() + 1)
+    )
+    crises['crisis_id'] = start.astype(int).groupby(crises['country_iso2']).cumsum()
+    for country, ids in MANUAL_CRISIS_IDS.items():
+        for date, crisis_id in ids.items():
+            crises.loc[
+                (crises['country_iso2'] == country) & (crises['dateQ'] == date),
+                'crisis_id'
+            ] = crisis_id
+    return crises
+
+
+def create_crises_variables(scores_cache: Path, output_folder: Path) -> None:
+    """Saves the country-quarter variables of the crises that do not
+    depend on the thresholds (see crises_variables) as a column store.
+
+    Args:
+        scores_cache (Path): Column store of the scores.
+        output_folder (Path): Folder of the column store.
+    """
+    print('Create crises variables...')
+    scores = read_scores(
+        scores_cache, columns=['country_iso2','country_name','dateQ','risk']
+    )
+    write_store(crises_variables(scores), output_folder)
+    return None
+
+
+def create_crises(variables_folder: Path, output_file: Path) -> None:
+    """Saves the crises of the countries in CRISIS_COUNTRIES (see
+    define_crises) as csv.
+
+    Args:
+        variables_folder (Path): Column store of the crises variables.
+        output_file (Path): The csv file.
+    """
+    print('Define local crises...')
+    write_crises(define_crises(read_store(variables_folder)), output_file)
+    return None
@@ -0,0 +1,80 @@
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class KeyDictionary:
+    """Dense integer ids for the distinct values of a string key (e.g.
+    gvkey). Ids follow the sorted order of the values, so sorting or
+    joining by ids gives the same order as by the values themselves.
+
+    Attributes:
+        values (pd.Index): The distinct values, sorted; the id of a value
+        is its position.
+    """
+
+    def __init__(self, *columns: Iterable):
+        uniques = [pd.unique(np.asarray(x, dtype=object)) for x in columns]
+        self.values = pd.Index(
+            np.concatenate(uniques) if uniques else [], dtype=object
+        ).dropna().unique().sort_values()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self, values: Iterable) -> np.ndarray:
+        """Ids of values; -1 if unknown or missing."""
+        return self.values.get_indexer(
+            np.asarray(values, dtype=object)
+        ).astype(np.int32)
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        """Values of ids; missing for -1."""
+        lookup = np.append(self.values.to_numpy(dtype=object), np.nan)
+        return lookup[np.asarray(ids)]
+
+
+def combine_keys(ids: np.ndarray, years: np.ndarray, first_year: int,
+                 nr_years: int) -> np.ndarray:
+    """Combines ids and years into one int64 key per row that sorts by id,
+    then year."""
+    return np.asarray(ids, dtype=np.int64) * nr_years + (
+        np.asarray(years, dtype=np.int64) - first_year
+    )
+
+
+def outer_join(
+    left_keys: np.ndarray, right_keys: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sorted merge-join of two unique integer keys, like a 1:1 outer merge.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The sorted union of the
+        keys, and for each of them its row in the left and in the right
+        keys (-1 if not there).
+
+    Raises:
+        pd.errors.MergeError: Raised if the keys of a side are not unique.
+    """
+    positions = []
+    for side, keys in [('left', left_keys), ('right', right_keys)]:
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        if np.any(sorted_keys[1:] == sorted_keys[:-1]):
+            raise pd.errors.MergeError(
+                f'Merge keys are not unique in {side} dataset; '
+                'not a one-to-one merge'
+            )
+        positions.append((sorted_keys, order))
+    keys = np.union1d(positions[0][0], positions[1][0])
+    rows = []
+    for sorted_keys, order in positions:
+        found = np.searchsorted(sorted_keys, keys)
+        found = np.minimum(found, max(len(sorted_keys) - 1, 0))
+        matched = (
+            sorted_keys[found] == keys if len(sorted_keys)
+            else np.zeros(len(keys), dtype=bool)
+        )
+        rows.append(np.where(matched, order[found] if len(order) else -1, -1))
+    return keys, rows[0], rows[1]
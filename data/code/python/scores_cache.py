@@ -0,0 +1,98 @@
+from pathlib import Path
+from typing import Iterable, Optional
+
+import pandas as pd
+
+from code.python.column_store import (
+    read_meta, read_store, source_signature, write_store
+)
+
+
+def is_cache_valid(
+    scores_file: Path, countrynames_file: Path, cache_folder: Path
+) -> bool:
+    try:
+        meta = read_meta(cache_folder)
+    except FileNotFoundError:
+        return False
+    return (
+        meta.get('source') == source_signature(scores_file)
+        and meta.get('countrynames') == source_signature(countrynames_file)
+    )
+
+
+def build_scores_cache(
+    scores_file: Path, countrynames_file: Path, cache_folder: Path
+) -> None:
+    """Converts the firm-country-quarter scores file into a column store,
+    unless the store was already created from the current scores file.
+
+    If the scores file has no column 'country_name', the names of the
+    countries of the scores (country_name) and of the firms' headquarters
+    (loc_cname) are not stored but looked up from their ISO-2 codes when
+    read, so the scores file itself is never rewritten.
+
+    Args:
+        scores_file (Path): File with CountryRisk measures (.dta).
+        countrynames_file (Path): File with the country ISO-2 codes (iso2)
+        and the country names (country_name).
+        cache_folder (Path): Folder of the column store.
+    """
+    if is_cache_valid(scores_file, countrynames_file, cache_folder):
+        print('Scores cache is up to date...')
+        return None
+    print('Caching scores file...')
+    scores = pd.read_stata(scores_file)
+    derived = {}
+    if 'country_name' not in scores.columns:
+        countrynames = pd.read_stata(countrynames_file)
+        countrynames = dict(zip(countrynames['iso2'], countrynames['country_name']))
+        # Codes without name get an empty name, as Stata has no missing strings
+        derived = {
+            column: (
+                source,
+                {x: countrynames.get(x, '') for x in scores[source].unique()},
+            )
+            for column, source in [
+                ('loc_cname', 'loc_iso2'), ('country_name', 'country_iso2')
+            ]
+        }
+    write_store(
+        scores,
+        cache_folder,
+        meta={
+            'source': source_signature(scores_file),
+            'countrynames': source_signature(countrynames_file),
+        },
+        derived=derived,
+    )
+    return None
+
+
+def read_scores(
+    cache_folder: Path, columns: Optional[Iterable[str]] = None
+) -> pd.DataFrame:
+    """Reads columns of the scores file from its column store. The store
+    is only built by the build_scores_cache step, which reruns whenever
+    the scores file changes.
+
+    Args:
+        cache_folder (Path): Folder of the column store.
+        columns (Optional[Iterable[str]]): Columns to read; all if None.
+
+    Raises:
+        RuntimeError: Raised if the scores file changed since the store
+        was created.
+
+    Returns:
+        pd.DataFrame: Firm-country-quarter scores.
+    """
+    meta = read_meta(cache_folder)
+    scores_file = Path(meta['source']['path'])
+    countrynames_file = Path(meta['countrynames']['path'])
+    if not is_cache_valid(scores_file, countrynames_file, cache_folder):
+        raise RuntimeError(
+            f'Scores cache {cache_folder} is out of date with {scores_file}; '
+            'run the build_scores_cache step first.'
+        )
+    return read_store(cache_folder, columns=columns)
@@ -0,0 +1,225 @@
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from code.python.column_store import read_store, write_store
+from code.python.countryrisk_less_noisy import read_firmcountryquarter
+from code.python.define_crises import number_crises, read_crises
+
+# Sets of firms whose transmission risk is collapsed separately
+FIRM_TYPES = ['ALL', 'FIN', 'NFC']
+
+# Origin-destination-quarters enter the tau data if they have more firms
+MIN_FIRMS = 10
+
+
+def is_financial(sic: pd.Series) -> np.ndarray:
+    """Financial firms have SIC codes 6000-6799; firms without (numeric)
+    SIC code count as non-financial, as in the do files."""
+    return pd.to_numeric(sic, errors='coerce').between(
+        6000, 6800, inclusive='left'
+    ).to_numpy()
+
+
+def origin_destination_quarter(firmcountryquarter: pd.DataFrame) -> pd.DataFrame:
+    """Collapses the firm-country-quarter data of foreign firms to the
+    origin (country_iso2), destination (loc_iso2), and quarter for all,
+    financial, and non-financial firms at once: the cells are coded once
+    and each set of firms only adds a few bincounts.
+
+    TransmissionRisk<type> is the mean CountryRisk_less_noisy and
+    nr_of_firms<type> the number of distinct firms (both missing if the
+    cell has no firm of the type); risk is the mean risk of all firms.
+
+    Args:
+        firmcountryquarter (pd.DataFrame): Firm-country-quarter data with
+        gvkey, country_iso2, loc_iso2, dateQ, sic, risk, and
+        CountryRisk_less_noisy.
+
+    Returns:
+        pd.DataFrame: Origin-destination-quarter data, sorted by
+        country_iso2, loc_iso2, and dateQ.
+    """
+    # Drop domestic firms' views about own country
+    data = firmcountryquarter[
+        firmcountryquarter['country_iso2'] != firmcountryquarter['loc_iso2']
+    ]
+    grouped = data.groupby(['country_iso2','loc_iso2','dateQ'], sort=True, dropna=False)
+    cell = grouped.ngroup().to_numpy()
+    collapsed = grouped.size().index.to_frame(index=False)
+    nr_of_cells = len(collapsed)
+    financial = is_financial(data['sic'])
+    masks = {'ALL': np.ones(len(data), dtype=bool), 'FIN': financial, 'NFC': ~financial}
+    # Count each firm once per country-quarter (and for FIN and NFC, once
+    # per country-quarter and financial flag)
+    firm_keys = data[['gvkey','country_iso2','dateQ']].assign(fin=financial)
+    first_all = ~firm_keys.duplicated(['gvkey','country_iso2','dateQ']).to_numpy()
+    first_type = ~firm_keys.duplicated().to_numpy()
+
+    def mean(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        valid = mask & ~np.isnan(values)
+        total = np.bincount(cell, weights=np.where(valid, values, 0), minlength=nr_of_cells)
+        count = np.bincount(cell, weights=valid, minlength=nr_of_cells)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(count > 0, total / count, np.nan)
+
+    transmissionrisk = data['CountryRisk_less_noisy'].to_numpy(dtype=float)
+    for firm_type, mask in masks.items():
+        first = first_all if firm_type == 'ALL' else first_type
+        present = np.bincount(cell, weights=mask, minlength=nr_of_cells) > 0
+        collapsed[f'TransmissionRisk{firm_type}'] = mean(transmissionrisk, mask)
+        collapsed[f'nr_of_firms{firm_type}'] = np.where(
+            present,
+            np.bincount(cell, weights=mask & first, minlength=nr_of_cells),
+            np.nan
+        )
+    collapsed['risk'] = mean(data['risk'].to_numpy(dtype=float), masks['ALL'])
+    return collapsed
+
+
+def origin_destination_tau(
+    od_quarter: pd.DataFrame, crises: pd.DataFrame, min_firms: float = MIN_FIRMS
+) -> pd.DataFrame:
+    """Collapses the origin-destination-quarter data to the origin,
+    destination, type of firms, and crisis (crisis_nr; 0 outside of local
+    crises).
+
+    Global crises are left out, and so are origin-destination-quarters
+    with at most min_firms firms. Crisis quarters without any
+    origin-destination-quarter are kept, without destination, as the
+    Stata build kept them (missing firm counts exceed any threshold).
+    The transmission risks are divided by their sd by type of firms;
+    mTREXCL is the standardized transmission risk outside of crises of
+    the same origin, destination, and type (missing if 0).
+
+    Args:
+        od_quarter (pd.DataFrame): Output of origin_destination_quarter.
+        crises (pd.DataFrame): Crises with country_iso2, dateQ, and
+        nolocal (see read_crises).
+        min_firms (float): Threshold of nr_of_firmsALL.
+
+    Returns:
+        pd.DataFrame: Origin-destination-tau data with crisis_id and
+        crisisfull_id (groups of country_iso2 and crisis_nr, the first
+        only for crises), sorted by country_iso2, loc_iso2, type, and
+        crisis_nr.
+    """
+    crises = number_crises(crises)
+    data = crises.merge(od_quarter, on=['country_iso2','dateQ'], how='outer')
+    # > min_firms firms and local crisis
+    nr_of_firms = data['nr_of_firmsALL'].to_numpy(dtype=float)
+    data = data[
+        (data['nolocal'] != 'yes').to_numpy()
+        & (np.isnan(nr_of_firms) | (nr_of_firms > min_firms))
+    ]
+    data = data.assign(
+        crisis_nr=data['crisis_id'].fillna(0).astype(int),
+        loc_iso2=data['loc_iso2'].fillna(''),
+    )
+    # Reshape to tuck type={ALL,FIN,NFC} into a new variable
+    long = pd.concat(
+        [
+            data[['country_iso2','loc_iso2','crisis_nr']].assign(
+                type=firm_type,
+                TransmissionRisk=data[f'TransmissionRisk{firm_type}'],
+                nr_of_firms=data[f'nr_of_firms{firm_type}'],
+            )
+            for firm_type in FIRM_TYPES
+        ],
+        ignore_index=True
+    )
+    long['TransmissionRiskEXCLCrisis'] = long['TransmissionRisk'].where(long['crisis_nr'] == 0)
+    long['TransmissionRiskCrisis'] = long['TransmissionRisk'].where(long['crisis_nr'] > 0)
+    # Average over quarters to tau
+    tau = long.groupby(
+        ['country_iso2','loc_iso2','type','crisis_nr'], sort=True
+    )[[
+        'TransmissionRisk', 'TransmissionRiskEXCLCrisis',
+        'TransmissionRiskCrisis', 'nr_of_firms'
+    ]].mean().reset_index()
+    crisis = tau[['country_iso2','crisis_nr']]
+    tau['crisis_id'] = crisis[tau['crisis_nr'] != 0].groupby(
+        ['country_iso2','crisis_nr'], sort=True
+    ).ngroup() + 1
+    tau['crisisfull_id'] = crisis.groupby(
+        ['country_iso2','crisis_nr'], sort=True
+    ).ngroup() + 1
+    # Standardize by the same standard deviation
+    sd = tau.groupby('type')['TransmissionRisk'].transform('std')
+    for column in ['TransmissionRisk', 'TransmissionRiskEXCLCrisis', 'TransmissionRiskCrisis']:
+        tau[column] = tau[column] / sd
+    # Proper TransmissionRiskEXCLCrisis (one per origin-destination-type)
+    tau['mTREXCL'] = tau['TransmissionRiskEXCLCrisis'].replace(0, np.nan).groupby(
+        [tau['country_iso2'], tau['loc_iso2'], tau['type']]
+    ).transform('max')
+    # TransmissionRisk - meanTransmissionRiskEXCL
+    tau['TransmissionRisk_dm'] = tau['TransmissionRisk'] - tau['mTREXCL']
+    return tau
+
+
+def encode(values: pd.Series) -> Tuple[pd.Series, Dict[int, str]]:
+    """Codes strings like Stata's encode: 1, 2, ... in sorted order, and
+    missing for empty strings.
+
+    Returns:
+        Tuple[pd.Series, Dict[int, str]]: The codes and their labels.
+    """
+    labels = sorted(x for x in values.dropna().unique() if x != '')
+    codes = values.map({x: i for i, x in enumerate(labels, start=1)})
+    return codes, dict(enumerate(labels, start=1))
+
+
+def create_transmissionrisk_tau(
+    od_quarter_folder: Path, crises_file: Path, output_file: Path
+) -> None:
+    """Saves the origin-destination-tau data (see origin_destination_tau)
+    as .dta, with the origins, destinations, and types of firms encoded
+    (country_id, hq_id, type_id) for the Stata code of Table 7.
+
+    Args:
+        od_quarter_folder (Path): Column store of the
+        origin-destination-quarter data.
+        crises_file (Path): Crises (csv).
+        output_file (Path): The .dta file.
+    """
+    print('Create transmissionrisk origin-destination-tau level data...')
+    tau = origin_destination_tau(
+        read_origin_destination_quarter(od_quarter_folder), read_crises(crises_file)
+    )
+    value_labels = {}
+    for column, source in [
+        ('country_id', 'country_iso2'), ('hq_id', 'loc_iso2'), ('type_id', 'type')
+    ]:
+        tau[column], value_labels[column] = encode(tau[source])
+    tau = tau[[
+        'country_iso2', 'loc_iso2', 'type', 'crisis_nr', 'TransmissionRisk',
+        'TransmissionRiskEXCLCrisis', 'TransmissionRiskCrisis', 'nr_of_firms',
+        'crisis_id', 'crisisfull_id', 'country_id', 'hq_id', 'type_id',
+        'mTREXCL', 'TransmissionRisk_dm'
+    ]]
+    tau.to_stata(output_file, write_index=False, value_labels=value_labels)
+    return None
+
+
+def create_origin_destination_quarter(
+    firmcountryquarter_folder: Path, output_folder: Path
+) -> None:
+    """Saves the origin-destination-quarter data (see
+    origin_destination_quarter) as a column store."""
+    print('Collapse transmission risk to origin-destination-quarter...')
+    firmcountryquarter = read_firmcountryquarter(
+        firmcountryquarter_folder,
+        columns=[
+            'gvkey', 'country_iso2', 'loc_iso2', 'dateQ', 'sic', 'risk',
+            'CountryRisk_less_noisy'
+        ]
+    )
+    write_store(origin_destination_quarter(firmcountryquarter), output_folder)
+    return None
+
+
+def read_origin_destination_quarter(folder: Path) -> pd.DataFrame:
+    """Reads the origin-destination-quarter data from its column store."""
+    return read_store(folder)
@@ -3,8 +3,12 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from code.python.countryidentifiers_import import CountryIdentifiers
 
-def import_worldbank_gdp(input_file: Path, output_file: Path) -> None:
+
+def import_worldbank_gdp(
+    input_file: Path, output_file: Path, countries: CountryIdentifiers
+) -> None:
     print('Import World GDP...')
     # Import world gdp
     gdp_df = pd.read_csv(input_file)
@@ -78,19 +82,8 @@ def import_worldbank_gdp(input_file: Path, output_file: Path) -> None:
         gdp=lambda v: v['gdp'].replace('..', np.nan).astype('float32')
     )
     # Rename countries to be consistent with our naming
-    name_mapping = {
-        'Egypt, Arab Rep.': 'Egypt',
-        'Hong Kong SAR, China': 'Hong Kong',
-        'Russian Federation': 'Russia',
-        'Korea, Rep.': 'South Korea',
-        'Virgin Islands (U.S.)': 'U.S. Virgin Islands',
-        'Turkiye':'Turkey',
-        'Iran, Islamic Rep.': 'Iran'
-    }
     gdp_df = gdp_df.assign(
-        country_name=lambda x: x['country_name'].apply(
-            lambda v: name_mapping[v] if v in name_mapping else v
-        )
+        country_name=lambda x: countries.normalize_names(x['country_name'])
     )
     # Keep only 2019
     gdp_df = gdp_df[
@@ -1,29 +1,54 @@
 import argparse
+from functools import partial
 import os
 from pathlib import Path
 import shutil
-import subprocess
-from typing import Dict, Iterable, Union
+import sys
+from typing import Dict, Iterable, List, Union
 
 import yaml  # type: ingore
 
 from code.python.countryidentifiers_import import (
     import_countryidentifiers,
-    add_countrynames,
+    load_countryidentifiers,
 )
 from code.python.compustat_import import import_compustat
 from code.python.worldbank_gdp_import import import_worldbank_gdp
 from code.python.create_coverage_data import import_our_sample, create_coverage_data
 from code.python.country_quarter_decomposed import create_decomposed_country_quarter
-
+from code.python.country_quarter_samples import (
+    create_country_quarter_samples,
+    samples_file,
+)
+from code.python.scores_cache import build_scores_cache
 
 # project root
 ROOT = Path(os.path.join(os.path.abspath(os.path.dirname(__file__)), "../"))
+sys.path.append(ROOT.as_posix())
+
+from pipeline.dag import Pipeline, Step, as_paths  # noqa: E402
+from pipeline.plan import add_estimates, print_plan  # noqa: E402
+from pipeline.stata import cancel_running, run_stata, set_timeouts  # noqa: E402
+from pipeline.telemetry import Telemetry  # noqa: E402
+from code.python.countryrisk_less_noisy import (  # noqa: E402
+    create_countryrisk_less_noisy,
+)
+from code.python.define_crises import (  # noqa: E402
+    create_crises,
+    create_crises_variables,
+)
+from code.python.transmissionrisk import (  # noqa: E402
+    create_origin_destination_quarter,
+    create_transmissionrisk_tau,
+)
+from code.python.crisis_sweep import crisis_sweep  # noqa: E402
 
 # config file, input and output folder
 CONFIG_FILE = ROOT.joinpath("config.yaml")
 DATA = ROOT.joinpath("data")
 RAW_DATA = ROOT.joinpath("raw")
+# Resource usage of earlier runs, kept by --clean_slate
+HISTORY_FILE = DATA.joinpath("run_history.jsonl")
 
 
 def check_files_exist(file_dict: Dict[str, str]) -> Dict[str, str]:
@@ -63,12 +88,514 @@ def prepend_files(
     return data_files
 
 
+def sweep_files(temp: Path) -> Dict[str, Path]:
+    """Cached intermediates that the crisis sweep reads, by argument of
+    crisis_sweep; build_steps declares the steps that write them."""
+    return {
+        "variables_folder": temp.joinpath("crises_variables"),
+        "od_quarter_folder": temp.joinpath("transmissionrisk_OriginDestinationQuarter"),
+        "firmcountryquarter_folder": temp.joinpath("transmissionrisk_FirmCountryQuarter"),
+    }
+
+
+def build_steps(
+    config_dict: dict,
+    raw_data: Dict[str, Union[Path, Iterable[Path]]],
+    final_data: Dict[str, Union[Path, Iterable[Path]]],
+) -> List[Step]:
+    """Declares all steps of the data build, in an order in which they can run.
+
+    Args:
+        config_dict (dict): Content of config.yaml.
+        raw_data (Dict[str, Union[Path, Iterable[Path]]]): Raw data files.
+        final_data (Dict[str, Union[Path, Iterable[Path]]]): Final data files.
+
+    Returns:
+        List[Step]: The steps.
+    """
+    temp = DATA.joinpath("temp")
+    python_code = DATA.joinpath("code/python")
+    stata_code = DATA.joinpath("code/stata")
+    stata_exec = config_dict["general"]["stata_exec"]
+
+    def stata_step(
+        name: str, description: str, args: List, inputs: List[Path],
+        outputs: List[Path], extra_code: Iterable[Path] = (),
+    ) -> Step:
+        do_file = stata_code.joinpath(f"{name}.do")
+        return Step(
+            name=name,
+            action=partial(run_stata, stata_exec, do_file, args),
+            inputs=inputs,
+            outputs=outputs,
+            code=[do_file, *extra_code],
+            params=[str(x) for x in args],
+            description=description,
+        )
+
+    iso2_iso3 = temp.joinpath("iso2_iso3.dta")
+    iso2_names = temp.joinpath("iso2_names.dta")
+    crises = temp.joinpath("crises.csv")
+    firmcountryquarter = temp.joinpath("transmissionrisk_FirmCountryQuarter.dta")
+    sweep = sweep_files(temp)
+    firmcountryquarter_store = sweep["firmcountryquarter_folder"]
+    crises_variables = sweep["variables_folder"]
+    od_quarter = sweep["od_quarter_folder"]
+    crises_integers_do = stata_code.joinpath("crises_integers.do")
+    scores = raw_data["SCORES_FILE"]
+    scores_cache = temp.joinpath("scores_cache")
+    country_quarter_samples = temp.joinpath("country_quarter_samples.dta")
+    weights = config_dict.get("country_quarter", {}).get("weights") or []
+    identifier_files = as_paths(raw_data["COUNTRYIDENTIFIERS_FILES"])
+    identifiers_code = python_code.joinpath("countryidentifiers_import.py")
+
+    return [
+        # Import country identifiers
+        Step(
+            name="import_countryidentifiers",
+            action=partial(
+                import_countryidentifiers,
+                input_files=raw_data["COUNTRYIDENTIFIERS_FILES"],
+                output_folder=temp,
+            ),
+            inputs=identifier_files,
+            outputs=[iso2_iso3, iso2_names],
+            code=[identifiers_code],
+        ),
+        # Convert scores file into a column store for the Python steps
+        Step(
+            name="build_scores_cache",
+            action=partial(build_scores_cache, scores, iso2_names, scores_cache),
+            inputs=[scores, iso2_names],
+            outputs=[scores_cache],
+            code=[
+                python_code.joinpath("scores_cache.py"),
+                python_code.joinpath("column_store.py"),
+            ],
+        ),
+        # Import worldbank GDP (2019)
+        Step(
+            name="import_worldbank_gdp",
+            action=lambda: import_worldbank_gdp(
+                input_file=raw_data["WORLDBANK_FILE"],
+                output_file=final_data["GDP_FILE"],
+                countries=load_countryidentifiers(identifier_files),
+            ),
+            inputs=[raw_data["WORLDBANK_FILE"], *identifier_files],
+            outputs=[final_data["GDP_FILE"]],
+            code=[python_code.joinpath("worldbank_gdp_import.py"), identifiers_code],
+        ),
+        # Import Compustat
+        Step(
+            name="import_compustat",
+            # The number of processes does not change the output, so it
+            # is not a parameter of the fingerprint
+            action=partial(
+                import_compustat,
+                raw_data["COMPUSTAT_FILES"],
+                temp,
+                **config_dict.get("compustat_import", {}),
+            ),
+            inputs=as_paths(raw_data["COMPUSTAT_FILES"]),
+            outputs=[
+                temp.joinpath("compustat_company"),
+                temp.joinpath("compustat_marketcap"),
+            ],
+            code=[
+                python_code.joinpath("compustat_import.py"),
+                python_code.joinpath("column_store.py"),
+            ],
+        ),
+        # Import our sample of firms
+        Step(
+            name="import_our_sample",
+            action=partial(
+                import_our_sample, scores_cache, temp.joinpath("our_sample.pkl")
+            ),
+            inputs=[scores_cache],
+            outputs=[temp.joinpath("our_sample.pkl")],
+            code=[python_code.joinpath("create_coverage_data.py")],
+        ),
+        # Create data set and year x country aggregates for Table 1 and Figure 1
+        Step(
+            name="create_coverage_data",
+            action=lambda: create_coverage_data(
+                temp,
+                load_countryidentifiers(identifier_files),
+                temp.joinpath("our_sample.pkl"),
+                final_data["COVERAGE_FILE"],
+                final_data["COVERAGE_CUBE_FILE"],
+            ),
+            inputs=[
+                temp.joinpath("compustat_marketcap"),
+                *identifier_files,
+                temp.joinpath("our_sample.pkl"),
+            ],
+            outputs=[
+                final_data["COVERAGE_FILE"],
+                final_data["COVERAGE_CUBE_FILE"],
+            ],
+            code=[
+                python_code.joinpath("create_coverage_data.py"),
+                python_code.joinpath("compustat_import.py"),
+                identifiers_code,
+            ],
+        ),
+        # Create data set for Figures 2-4
+        Step(
+            name="create_decomposed_country_quarter",
+            action=partial(
+                create_decomposed_country_quarter,
+                scores_cache,
+                final_data["DECOMPOSED_FIN_FILE"].as_posix().replace("_fin", "_XXX"),
+            ),
+            inputs=[scores_cache],
+            outputs=[
+                final_data["DECOMPOSED_FIN_FILE"],
+                final_data["DECOMPOSED_HQ_FILE"],
+            ],
+            code=[python_code.joinpath("country_quarter_decomposed.py")],
+        ),
+        stata_step(
+            "cfnai_import",
+            "Import CFNAI...",
+            [raw_data["CFNAI_FILE"], temp.joinpath("cfnaiQ.dta").as_posix()],
+            inputs=[raw_data["CFNAI_FILE"]],
+            outputs=[temp.joinpath("cfnaiQ.dta")],
+        ),
+        stata_step(
+            "ifs_gdp_import",
+            "Import IMF IFS GDP...",
+            [raw_data["IMF_IFS_GDP_FILE"], temp.joinpath("ifs_gdpQ.dta").as_posix()],
+            inputs=[raw_data["IMF_IFS_GDP_FILE"]],
+            outputs=[temp.joinpath("ifs_gdpQ.dta")],
+        ),
+        stata_step(
+            "imf_capitalflows_import",
+            "Import IMF capital flows...",
+            [
+                f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["BOP_CODES"]}"',
+                f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["BOP_TIMESERIES"]}"',
+                f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["COUNTRYCODES"]}"',
+                temp.joinpath("grcf_capital_flows.dta").as_posix(),
+                temp.as_posix(),
+            ],
+            inputs=as_paths(raw_data["IMF_CAPITALFLOWS_FILES"]),
+            outputs=[temp.joinpath("grcf_capital_flows.dta")],
+        ),
+        stata_step(
+            "msci_returns_import",
+            "Import MSCI...",
+            [
+                f'"{raw_data["MSCI_FILE"]}"',
+                temp.joinpath("msci_returnsQ.dta").as_posix(),
+                temp,
+            ],
+            inputs=[raw_data["MSCI_FILE"]],
+            outputs=[temp.joinpath("msci_returnsQ.dta")],
+        ),
+        stata_step(
+            "markit_cds_import",
+            "Import Markit CDS...",
+            [f'"{raw_data["MARKIT_FILE"]}"', temp.joinpath("markit_cdsQ.dta").as_posix()],
+            inputs=[raw_data["MARKIT_FILE"]],
+            outputs=[temp.joinpath("markit_cdsQ.dta")],
+        ),
+        stata_step(
+            "wui_import",
+            "Import World Uncertainty Index...",
+            [f'"{raw_data["WUI_FILE"]}"', temp.joinpath("wuiQ.dta").as_posix()],
+            inputs=[raw_data["WUI_FILE"]],
+            outputs=[temp.joinpath("wuiQ.dta")],
+        ),
+        stata_step(
+            "orbis_import",
+            "Import Orbis...",
+            [f'"{raw_data["ORBIS_FILE"]}"', temp.joinpath("orbis.dta").as_posix()],
+            inputs=[raw_data["ORBIS_FILE"]],
+            outputs=[temp.joinpath("orbis.dta")],
+        ),
+        stata_step(
+            "worldscope_import",
+            "Import Worldscope...",
+            [
+                f'"{raw_data["WORLDSCOPE_FILE"]}"',
+                f'"{raw_data["COMPUSTAT_NA_NAMES_FILE"]}"',
+                f'"{raw_data["COMPUSTAT_GLOBAL_NAMES_FILE"]}"',
+                final_data["WORLDSCOPE_FILE"].as_posix(),
+                temp.joinpath("worldscope_FirmCountry.dta").as_posix(),
+            ],
+            inputs=[
+                raw_data["WORLDSCOPE_FILE"],
+                raw_data["COMPUSTAT_NA_NAMES_FILE"],
+                raw_data["COMPUSTAT_GLOBAL_NAMES_FILE"],
+            ],
+            outputs=[
+                final_data["WORLDSCOPE_FILE"],
+                temp.joinpath("worldscope_FirmCountry.dta"),
+            ],
+        ),
+        stata_step(
+            "firmrisk_import",
+            "Import firm-level risk...",
+            [f'"{raw_data["FIRMLEVELRISK_FILE"]}"', temp.joinpath("firmrisk.dta").as_posix()],
+            inputs=[raw_data["FIRMLEVELRISK_FILE"]],
+            outputs=[temp.joinpath("firmrisk.dta")],
+        ),
+        # Country-quarter variables of the crises, for any threshold
+        Step(
+            name="crises_variables",
+            action=partial(create_crises_variables, scores_cache, crises_variables),
+            inputs=[scores_cache],
+            outputs=[crises_variables],
+            code=[
+                python_code.joinpath("define_crises.py"),
+                ROOT.joinpath("pipeline/hdfe.py"),
+            ],
+        ),
+        # Define local crises
+        Step(
+            name="define_crises",
+            action=partial(create_crises, crises_variables, crises),
+            inputs=[crises_variables],
+            outputs=[crises],
+            code=[python_code.joinpath("define_crises.py")],
+        ),
+        # Define CountryRisk_ict (less noisy)
+        Step(
+            name="countryrisk_less_noisy",
+            action=partial(
+                create_countryrisk_less_noisy,
+                scores_cache,
+                firmcountryquarter_store,
+                firmcountryquarter,
+            ),
+            inputs=[scores_cache],
+            outputs=[firmcountryquarter_store, firmcountryquarter],
+            code=[
+                python_code.joinpath("countryrisk_less_noisy.py"),
+                ROOT.joinpath("pipeline/hdfe.py"),
+            ],
+        ),
+        # Collapse transmission risk to origin-destination-quarter for all,
+        # financial, and non-financial firms
+        Step(
+            name="origin_destination_quarter",
+            action=partial(
+                create_origin_destination_quarter,
+                firmcountryquarter_store,
+                od_quarter,
+            ),
+            inputs=[firmcountryquarter_store],
+            outputs=[od_quarter],
+            code=[python_code.joinpath("transmissionrisk.py")],
+        ),
+        # Collapse the scores by country-quarter for all sets of firms
+        # (and with the weights of Appendix Table 11, if any)
+        Step(
+            name="create_country_quarter_samples",
+            action=partial(
+                create_country_quarter_samples,
+                scores_cache,
+                country_quarter_samples,
+                weights,
+            ),
+            inputs=[scores_cache],
+            outputs=[
+                samples_file(country_quarter_samples, x) for x in ["", *weights]
+            ],
+            code=[python_code.joinpath("country_quarter_samples.py")],
+            params=weights,
+        ),
+        stata_step(
+            "country_quarter",
+            "Create country-quarter level data...",
+            [
+                country_quarter_samples.as_posix(),
+                final_data["COUNTRYQUARTER_FILE"].as_posix(),
+                temp,
+                raw_data["FORBESWARNOCK_FILE"],
+            ],
+            inputs=[
+                country_quarter_samples,
+                temp.joinpath("firmrisk.dta"),
+                iso2_iso3,
+                iso2_names,
+                temp.joinpath("grcf_capital_flows.dta"),
+                raw_data["FORBESWARNOCK_FILE"],
+                temp.joinpath("msci_returnsQ.dta"),
+                temp.joinpath("markit_cdsQ.dta"),
+                temp.joinpath("wuiQ.dta"),
+                temp.joinpath("ifs_gdpQ.dta"),
+                crises,
+            ],
+            outputs=[final_data["COUNTRYQUARTER_FILE"]],
+        ),
+        stata_step(
+            "firm_country",
+            "Create firm-country level data...",
+            [f'"{scores}"', final_data["FIRMCOUNTRY_FILE"].as_posix(), temp],
+            inputs=[
+                scores,
+                iso2_names,
+                iso2_iso3,
+                temp.joinpath("orbis.dta"),
+                temp.joinpath("worldscope_FirmCountry.dta"),
+            ],
+            outputs=[final_data["FIRMCOUNTRY_FILE"]],
+        ),
+        stata_step(
+            "transmissionrisk_OriginDestination",
+            "Create transmissionrisk origin-destination level data...",
+            [
+                temp.as_posix(),
+                final_data["TRANSMISSIONRISK_FILE"].as_posix(),
+                crises_integers_do.as_posix(),
+            ],
+            inputs=[firmcountryquarter, crises],
+            outputs=[final_data["TRANSMISSIONRISK_FILE"]],
+            extra_code=[crises_integers_do],
+        ),
+        # Collapse transmission risk to origin-destination-tau
+        Step(
+            name="transmissionrisk_OriginDestinationTau",
+            action=partial(
+                create_transmissionrisk_tau,
+                od_quarter,
+                crises,
+                final_data["TRANSMISSIONRISK_TAU_FILE"],
+            ),
+            inputs=[od_quarter, crises],
+            outputs=[final_data["TRANSMISSIONRISK_TAU_FILE"]],
+            code=[
+                python_code.joinpath("transmissionrisk.py"),
+                python_code.joinpath("define_crises.py"),
+            ],
+        ),
+        stata_step(
+            "transmissionrisk_OriginFirmTau",
+            "Create transmissionrisk origin-firm-tau level data...",
+            [
+                temp.as_posix(),
+                final_data["TRANSMISSIONRISK_FIRM_TAU_FILE"].as_posix(),
+                crises_integers_do.as_posix(),
+            ],
+            inputs=[firmcountryquarter, crises],
+            outputs=[final_data["TRANSMISSIONRISK_FIRM_TAU_FILE"]],
+            extra_code=[crises_integers_do],
+        ),
+    ]
+
+
+def resolve_targets(
+    targets: Iterable[str],
+    config_dict: dict,
+    final_data: Dict[str, Union[Path, Iterable[Path]]],
+    pipeline: Pipeline,
+) -> List[str]:
+    """Translates targets into the names of the steps that produce them.
+    A target is a step name, a figure or table of the paper (see targets
+    in config.yaml), a key of final_data, or the path of an output file.
+
+    Raises:
+        ValueError: Raised if a target is unknown.
+    """
+    steps = []
+    for target in targets:
+        if target in pipeline.dependencies:
+            steps.append(target)
+            continue
+        if target in config_dict["targets"]:
+            files = [
+                p
+                for key in config_dict["targets"][target]
+                for p in as_paths(final_data[key])
+            ]
+        elif target in final_data:
+            files = as_paths(final_data[target])
+        else:
+            files = [Path(target).resolve()]
+        producers = [pipeline.producer(p) for p in files]
+        if not any(producers) and target not in config_dict["targets"]:
+            raise ValueError(f"Unknown target: {target}")
+        steps.extend(x for x in producers if x is not None)
+    return steps
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Processes all raw data to create analysis data sets."
     )
     parser.add_argument("--clean_slate", action="store_true", default=False)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Run all steps, even those that are up to date.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of steps that may run at the same time.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        default=False,
+        help="Only print the steps that would run, with their inputs, outputs, "
+        "and estimated wall time and peak memory; run nothing.",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        metavar="TARGET",
+        help="Build only these targets and what they depend on, e.g. Figure7 "
+        "Table6, a step name, a key of final_data, or an output file.",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        default=False,
+        help="Evaluate the grid of crisis thresholds in crisis_sweep of "
+        "config.yaml (crisis counts and Table 7 estimates) on the cached "
+        "intermediates, which are built first if needed; --jobs settings are "
+        "evaluated at the same time. Writes temp/crisis_sweep.csv. With "
+        "--plan, only lists the steps that build the intermediates.",
+    )
     args = parser.parse_args()
+    if args.sweep and (args.only or args.clean_slate):
+        parser.error("--sweep builds only its intermediates, so it cannot be "
+                     "combined with --only or --clean_slate.")
+    if args.only and args.clean_slate:
+        parser.error("--only keeps all other output, so it cannot be combined "
+                     "with --clean_slate.")
+
+    # load config yaml
+    with CONFIG_FILE.open("r", encoding="utf-8") as stream:
+        try:
+            config_dict = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+        # add absolute path to files
+        final_data = prepend_files(config_dict["final_data"], DATA)
+        raw_data = prepend_files(config_dict["raw_data"], RAW_DATA)
+
+    # Only show what would run, with estimates from earlier runs
+    if args.plan:
+        pipeline = Pipeline(
+            build_steps(config_dict, raw_data, final_data),
+            state_file=DATA.joinpath("temp/build_state.json"),
+        )
+        only = None
+        if args.only:
+            only = resolve_targets(args.only, config_dict, final_data, pipeline)
+        if args.sweep:
+            only = [pipeline.producer(x) for x in sweep_files(DATA.joinpath("temp")).values()]
+        planned = pipeline.plan(force=args.force or args.clean_slate, only=only)
+        add_estimates(planned, HISTORY_FILE)
+        print_plan(planned, jobs=args.jobs)
+        sys.exit(0)
 
     # Replace existing output folder with empty folder
     if args.clean_slate:
@@ -86,312 +613,38 @@ if __name__ == "__main__":
     if not DATA.joinpath("logs").exists():
         DATA.joinpath("logs").mkdir()
 
-    # load config yaml
-    with CONFIG_FILE.open("r", encoding="utf-8") as stream:
-        try:
-            config_dict = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-        # add absolute path to files
-        final_data = prepend_files(config_dict["final_data"], DATA)
-        raw_data = prepend_files(config_dict["raw_data"], RAW_DATA)
+    # Run all steps whose code or inputs changed since the last run; the
+    # first step that fails stops the do files that are still running
+    set_timeouts(config_dict.get("stata_timeouts"))
+    telemetry = Telemetry()
+    pipeline = Pipeline(
+        build_steps(config_dict, raw_data, final_data),
+        state_file=DATA.joinpath("temp/build_state.json"),
+        telemetry=telemetry,
+        on_failure=cancel_running,
+    )
+    only = None
+    if args.only:
+        only = resolve_targets(args.only, config_dict, final_data, pipeline)
+        print("Building only: " + ", ".join(sorted(pipeline.upstream(only))))
+    if args.sweep:
+        # The sweep needs the crises variables and the transmission risk data
+        only = [pipeline.producer(x) for x in sweep_files(DATA.joinpath("temp")).values()]
 
     # Change folder so that Stata logs end up in the correct folder
     os.chdir(DATA.joinpath("logs"))
 
-    # Import country identifiers
-    import_countryidentifiers(
-        input_files=raw_data["COUNTRYIDENTIFIERS_FILES"],
-        output_folder=DATA.joinpath("temp"),
-    )
-
-    # Ensure country names are in scores file
-    add_countrynames(
-        input_file=raw_data["SCORES_FILE"],
-        countrynames=import_countryidentifiers(
-            input_files=raw_data["COUNTRYIDENTIFIERS_FILES"],
-            output_folder=DATA.joinpath("temp"),
-            return_files=True,
-        )["iso2_names.json"],
-    )
-
-    # Import worldbank GDP (2019)
-    import_worldbank_gdp(
-        input_file=raw_data["WORLDBANK_FILE"],
-        output_file=DATA.joinpath("final/worldbank_gdp_2019.csv"),
-    )
-
-    # Import Compustat
-    import_compustat(raw_data["COMPUSTAT_FILES"], DATA.joinpath("temp"))
-
-    # Import our sample of firms
-    import_our_sample(
-        raw_data["SCORES_FILE"],
-        DATA.joinpath("temp/our_sample.pkl"),
-    )
-
-    # Create data set for Table 1 and Figure 1
-    create_coverage_data(
-        DATA.joinpath("temp/compustat_merged.pkl"),
-        DATA.joinpath("temp/iso2_names.dta"),
-        DATA.joinpath("temp/iso2_iso3.dta"),
-        DATA.joinpath("temp/our_sample.pkl"),
-        final_data["COVERAGE_FILE"],
-    )
-
-    # Create data set for Figures 2-4
-    create_decomposed_country_quarter(
-        raw_data["SCORES_FILE"],
-        final_data["DECOMPOSED_FIN_FILE"].as_posix().replace("_fin", "_XXX"),
-    )
-
-    # Import CFNAI
-    print("Import CFNAI...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/cfnai_import.do"',
-            raw_data["CFNAI_FILE"],
-            DATA.joinpath("temp/cfnaiQ.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import IMF IFS GDP
-    print("Import IMF IFS GDP...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/ifs_gdp_import.do"',
-            raw_data["IMF_IFS_GDP_FILE"],
-            DATA.joinpath("temp/ifs_gdpQ.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import IMF Capital flows
-    print("Import IMF capital flows...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/imf_capitalflows_import.do"',
-            f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["BOP_CODES"]}"',
-            f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["BOP_TIMESERIES"]}"',
-            f'"{raw_data["IMF_CAPITALFLOWS_FILES"]["COUNTRYCODES"]}"',
-            DATA.joinpath("temp/grcf_capital_flows.dta").as_posix(),
-            DATA.joinpath("temp").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import MSCI data
-    print("Import MSCI...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/msci_returns_import.do"',
-            f'"{raw_data["MSCI_FILE"]}"',
-            DATA.joinpath("temp/msci_returnsQ.dta").as_posix(),
-            DATA.joinpath("temp"),
-        ],
-        check=False,
-    )
-
-    # Import Markit CDS data
-    print("Import Markit CDS...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/markit_cds_import.do"',
-            f'"{raw_data["MARKIT_FILE"]}"',
-            DATA.joinpath("temp/markit_cdsQ.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import World Uncertainty Index
-    print("Import World Uncertainty Index...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/wui_import.do"',
-            f'"{raw_data["WUI_FILE"]}"',
-            DATA.joinpath("temp/wuiQ.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import Orbis
-    print("Import Orbis...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/orbis_import.do"',
-            f'"{raw_data["ORBIS_FILE"]}"',
-            DATA.joinpath("temp/orbis.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import Worldscope
-    print("Import Worldscope...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/worldscope_import.do"',
-            f'"{raw_data["WORLDSCOPE_FILE"]}"',
-            f'"{raw_data["COMPUSTAT_NA_NAMES_FILE"]}"',
-            f'"{raw_data["COMPUSTAT_GLOBAL_NAMES_FILE"]}"',
-            DATA.joinpath("final/worldscope_FirmYearCountry.dta").as_posix(),
-            DATA.joinpath("temp/worldscope_FirmCountry.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Import firm level risk
-    print("Import firm-level risk...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/firmrisk_import.do"',
-            f'"{raw_data["FIRMLEVELRISK_FILE"]}"',
-            DATA.joinpath("temp/firmrisk.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Define crises
-    print("Define local crises...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/define_crises.do"',
-            f'"{raw_data["SCORES_FILE"]}"',
-            DATA.joinpath("temp/iso2_names.dta").as_posix(),
-            DATA.joinpath("code/stata/crises_variables.do").as_posix(),
-            DATA.joinpath("temp/crises.csv").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Define CountryRisk_ict
-    print("Define CountryRisk_ict (less noisy)...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/countryrisk_less_noisy.do"',
-            f'"{raw_data["SCORES_FILE"]}"',
-            DATA.joinpath("temp/transmissionrisk_FirmCountryQuarter.dta").as_posix(),
-        ],
-        check=False,
-    )
-
-    # Create data sets
-    print("Create country-quarter level data...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/country_quarter.do"',
-            f'"{raw_data["SCORES_FILE"]}"',
-            DATA.joinpath("final/analysis_CountryQuarter.dta").as_posix(),
-            DATA.joinpath("temp"),
-            raw_data["FORBESWARNOCK_FILE"],
-        ],
-        check=False,
-    )
-
-    print("Create firm-country level data...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/firm_country.do"',
-            f'"{raw_data["SCORES_FILE"]}"',
-            DATA.joinpath("final/analysis_FirmCountry.dta").as_posix(),
-            DATA.joinpath("temp"),
-        ],
-        check=False,
-    )
-
-    print("Create transmissionrisk origin-destination level data...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/transmissionrisk_OriginDestination.do"',
-            DATA.joinpath("temp").as_posix(),
-            DATA.joinpath("final/transmissionrisk_OriginDestination.dta").as_posix(),
-            DATA.joinpath("code/stata/crises_integers.do").as_posix(),
-        ],
-        check=False,
-    )
-
-    print("Create transmissionrisk origin-destination-tau level data...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/transmissionrisk_OriginDestinationTau.do"',
-            DATA.joinpath("temp").as_posix(),
-            DATA.joinpath("final/transmissionrisk_OriginDestinationTau.dta").as_posix(),
-            DATA.joinpath("code/stata/crises_integers.do").as_posix(),
-        ],
-        check=False,
-    )
-
-    print("Create transmissionrisk origin-firm-tau level data...")
-    subprocess.run(
-        [
-            config_dict["general"]["stata_exec"],
-            "-q",
-            "-b",
-            "do",
-            f'"{DATA}/code/stata/transmissionrisk_OriginFirmTau.do"',
-            DATA.joinpath("temp").as_posix(),
-            DATA.joinpath("final/transmissionrisk_OriginFirmTau.dta").as_posix(),
-            DATA.joinpath("code/stata/crises_integers.do").as_posix(),
-        ],
-        check=False,
-    )
+    try:
+        pipeline.run(force=args.force, jobs=args.jobs, only=only)
+    finally:
+        report = telemetry.write_report(DATA.joinpath("logs"), "data")
+        telemetry.append_history(HISTORY_FILE)
+        print(f"Run report: {report}")
+
+    if args.sweep:
+        crisis_sweep(
+            **sweep_files(DATA.joinpath("temp")),
+            output_file=DATA.joinpath("temp/crisis_sweep.csv"),
+            grid=config_dict.get("crisis_sweep"),
+            jobs=args.jobs,
+        )
@@ -0,0 +1,326 @@
+""" Module providing an incremental build graph for the make.py files """
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from functools import partial
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Union
+
+from pipeline.plan import PlannedStep
+from pipeline.telemetry import Telemetry
+
+
+@dataclass
+class Step:
+    """One node of the build graph.
+
+    Args:
+        name (str): Unique name of the step.
+        action (Callable[[], None]): Function that produces the outputs.
+        inputs (List[Path]): Files (or folders) the step reads.
+        outputs (List[Path]): Files (or folders) the step writes.
+        code (List[Path]): Code files that define the step, e.g. the
+        Python module or the Stata do files.
+        params (Sequence[str]): Further arguments that change the result
+        of the step, e.g. the command line arguments of a do file.
+        description (Optional[str]): Printed before the step runs.
+    """
+    name: str
+    action: Callable[[], None]
+    inputs: List[Path] = field(default_factory=list)
+    outputs: List[Path] = field(default_factory=list)
+    code: List[Path] = field(default_factory=list)
+    params: Sequence[str] = field(default_factory=tuple)
+    description: Optional[str] = None
+
+
+class FileHasher:
+    """Content hashes of files, cached by path, size, and modification
+    time so that unchanged (large) raw files are only read once."""
+
+    def __init__(self, cache: Dict[str, list]):
+        self.cache = cache
+
+    def file_hash(self, path: Path) -> Optional[str]:
+        if not path.exists():
+            return None
+        if path.is_dir():
+            digest = hashlib.sha256()
+            for child in sorted(path.rglob('*')):
+                if child.is_file():
+                    digest.update(child.relative_to(path).as_posix().encode())
+                    digest.update(self.file_hash(child).encode())
+            return digest.hexdigest()
+        stat = path.stat()
+        key = path.as_posix()
+        cached = self.cache.get(key)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha256()
+        with path.open('rb') as infile:
+            for chunk in iter(lambda: infile.read(1 << 20), b''):
+                digest.update(chunk)
+        self.cache[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self.cache[key][2]
+
+
+class Pipeline:
+    """Runs steps in order and skips those whose fingerprint is unchanged.
+
+    The fingerprint of a step hashes its code files, its parameters, and
+    the content of its inputs. Since the inputs of a step are the outputs
+    of upstream steps, a change anywhere propagates downstream, but only
+    if the upstream step actually produced different content.
+
+    A step depends on the (last preceding) steps that write its inputs.
+    Steps whose dependencies are done can run concurrently.
+
+    Args:
+        steps (List[Step]): Steps in an order in which they can run.
+        state_file (Path): JSON file in which fingerprints are stored.
+        telemetry (Optional[Telemetry]): If given, measures the resources
+        used by each step that runs.
+        on_failure (Optional[Callable[[], None]]): Called when a step
+        fails, to stop the steps that are still running.
+    """
+
+    def __init__(
+        self,
+        steps: List[Step],
+        state_file: Path,
+        telemetry: Optional[Telemetry] = None,
+        on_failure: Optional[Callable[[], None]] = None
+    ):
+        names = [step.name for step in steps]
+        if len(set(names)) != len(names):
+            raise ValueError('Step names must be unique.')
+        self.steps = steps
+        self.dependencies = self._find_dependencies(steps)
+        self.state_file = state_file
+        self.telemetry = telemetry
+        self.on_failure = on_failure
+        self.state = self._load_state()
+        self.hasher = FileHasher(self.state.setdefault('files', {}))
+
+    @staticmethod
+    def _find_dependencies(steps: List[Step]) -> Dict[str, Set[str]]:
+        producers: Dict[Path, str] = {}
+        dependencies: Dict[str, Set[str]] = {}
+        for step in steps:
+            dependencies[step.name] = {
+                producers[p] for p in step.inputs if p in producers
+            }
+            for p in step.outputs:
+                producers[p] = step.name
+        return dependencies
+
+    def producer(self, path: Path) -> Optional[str]:
+        """Name of the (last) step that writes a file, if any."""
+        path = Path(path).resolve()
+        for step in reversed(self.steps):
+            if any(path == p.resolve() for p in step.outputs):
+                return step.name
+        return None
+
+    def upstream(self, names: Iterable[str]) -> Set[str]:
+        """Names of the given steps and of all steps they depend on."""
+        closure: Set[str] = set()
+        queue = list(names)
+        while queue:
+            name = queue.pop()
+            if name in closure:
+                continue
+            if name not in self.dependencies:
+                raise ValueError(f'Unknown step: {name}')
+            closure.add(name)
+            queue.extend(self.dependencies[name])
+        return closure
+
+    def _load_state(self) -> dict:
+        if self.state_file.exists():
+            with self.state_file.open('r', encoding='utf-8') as infile:
+                return json.load(infile)
+        return {'steps': {}, 'files': {}}
+
+    def _save_state(self) -> None:
+        tmp_file = self.state_file.with_suffix('.tmp')
+        with tmp_file.open('w', encoding='utf-8') as outfile:
+            json.dump(self.state, outfile, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
+
+    def fingerprint(self, step: Step) -> str:
+        content = {
+            'code': {p.as_posix(): self.hasher.file_hash(p) for p in step.code},
+            'inputs': {
+                p.as_posix(): self.hasher.file_hash(p) for p in step.inputs
+            },
+            'outputs': sorted(p.as_posix() for p in step.outputs),
+            'params': [str(x) for x in step.params],
+        }
+        return hashlib.sha256(
+            json.dumps(content, sort_keys=True).encode()
+        ).hexdigest()
+
+    def is_up_to_date(self, step: Step) -> bool:
+        recorded = self.state['steps'].get(step.name)
+        if recorded is None or recorded['fingerprint'] != self.fingerprint(step):
+            return False
+        # Outputs must still be there and unchanged since they were built
+        return all(
+            self.hasher.file_hash(p) == recorded['outputs'].get(p.as_posix())
+            for p in step.outputs
+        )
+
+    def record(self, step: Step) -> bool:
+        """Stores the fingerprint of a step that has just run. Returns
+        False (and stores nothing) if the step failed to create an output."""
+        missing = [p for p in step.outputs if not p.exists()]
+        if missing:
+            self.state['steps'].pop(step.name, None)
+            print(
+                f'Step {step.name} did not create '
+                + ', '.join(p.as_posix() for p in missing)
+            )
+            return False
+        # Fingerprint after running, so that steps that update their
+        # input in place are not considered stale on the next run
+        self.state['steps'][step.name] = {
+            'fingerprint': self.fingerprint(step),
+            'outputs': {
+                p.as_posix(): self.hasher.file_hash(p) for p in step.outputs
+            },
+        }
+        return True
+
+    def plan(
+        self,
+        force: bool = False,
+        only: Optional[Iterable[str]] = None
+    ) -> List[PlannedStep]:
+        """Lists the steps that run() would consider, without running any.
+        A step that is up to date itself may still run if an upstream step
+        runs and produces different output. A step with an input that does
+        not exist and that no step writes would fail (missing input).
+
+        Args:
+            force (bool): Run steps even if they are up to date.
+            only (Optional[Iterable[str]]): If given, only these steps and
+            the steps they depend on.
+        """
+        selected = None if only is None else self.upstream(only)
+        produced = {p.resolve() for step in self.steps for p in step.outputs}
+        planned: Dict[str, PlannedStep] = {}
+        for step in self.steps:
+            if selected is not None and step.name not in selected:
+                continue
+            # Inputs that no step writes must exist already
+            if any(
+                p.resolve() not in produced and not p.exists() for p in step.inputs
+            ):
+                status = 'missing input'
+            elif force or not self.is_up_to_date(step):
+                status = 'stale'
+            elif any(
+                planned[x].status != 'up to date'
+                for x in self.dependencies[step.name]
+            ):
+                status = 'after upstream'
+            else:
+                status = 'up to date'
+            planned[step.name] = PlannedStep(
+                name=step.name,
+                status=status,
+                inputs=list(step.inputs),
+                outputs=list(step.outputs),
+                dependencies=sorted(self.dependencies[step.name]),
+            )
+        return list(planned.values())
+
+    def _start(self, step: Step, force: bool) -> Optional[Callable[[], None]]:
+        """Returns the action of a step, or None if it is up to date."""
+        if not force and self.is_up_to_date(step):
+            print(f'{step.name} is up to date')
+            return None
+        if step.description is not None:
+            print(step.description)
+        if self.telemetry is None:
+            return step.action
+        return partial(self._measured, step)
+
+    def _measured(self, step: Step) -> None:
+        with self.telemetry.measure(step.name, step.inputs, step.outputs):
+            step.action()
+
+    def run(
+        self,
+        force: bool = False,
+        jobs: int = 1,
+        only: Optional[Iterable[str]] = None
+    ) -> None:
+        """Runs all steps that are not up to date.
+
+        Args:
+            force (bool): Run steps even if they are up to date.
+            jobs (int): Maximum number of steps that run at the same time.
+            only (Optional[Iterable[str]]): If given, runs only these steps
+            and the steps they depend on.
+        """
+        pending = list(self.steps)
+        if only is not None:
+            selected = self.upstream(only)
+            pending = [step for step in pending if step.name in selected]
+        done: Set[str] = set()
+        running: Dict[Future, Step] = {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while pending or running:
+                # Start all steps whose upstream steps are done
+                for step in list(pending):
+                    if len(running) >= max(jobs, 1):
+                        break
+                    if not self.dependencies[step.name] <= done:
+                        continue
+                    pending.remove(step)
+                    action = self._start(step, force)
+                    if action is None:
+                        done.add(step.name)
+                        continue
+                    running[executor.submit(action)] = step
+                if not running:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException:
+                        self._stop(step, running)
+                        raise
+                    if not self.record(step):
+                        self._stop(step, running)
+                        missing = [p.as_posix() for p in step.outputs if not p.exists()]
+                        raise RuntimeError(
+                            f'Step {step.name} did not create ' + ', '.join(missing)
+                        )
+                    self._save_state()
+                    done.add(step.name)
+
+    def _stop(self, step: Step, running: Dict[Future, Step]) -> None:
+        """Starts nothing else after a step failed and stops what is running."""
+        print(f'Step {step.name} failed, stopping the build')
+        self.state['steps'].pop(step.name, None)
+        self._save_state()
+        if self.on_failure is not None:
+            self.on_failure()
+        for other in running:
+            other.cancel()
+
+
+def as_paths(files: Union[Path, Sequence[Path], Dict[str, Path]]) -> List[Path]:
+    """Flattens the file entries of the config into a list of paths."""
+    if isinstance(files, dict):
+        return list(files.values())
+    if isinstance(files, (list, tuple)):
+        return list(files)
+    return [files]
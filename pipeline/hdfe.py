@@ -0,0 +1,258 @@
+""" Module providing linear regressions with high-dimensional fixed effects,
+like Stata's reghdfe, for the steps of both make.py files """
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+@dataclass
+class HDFEResult:
+    """Estimates of a regression with absorbed fixed effects.
+
+    Args:
+        coefficients (pd.Series): Coefficients of the regressors and the
+        constant (_cons).
+        covariance (pd.DataFrame): Their variance-covariance matrix.
+        residuals (pd.Series): Residuals (net of the fixed effects), on the
+        index of the data; missing outside of the estimation sample.
+        sample (pd.Series): Whether a row is in the estimation sample (not
+        missing and no singleton).
+        nobs (int): Number of observations.
+        df_a (int): Degrees of freedom of the fixed effects (including the
+        constant), net of redundant ones.
+        df_r (int): Residual degrees of freedom, N - K - df_a.
+        nclusters (Optional[int]): Number of clusters, if clustered.
+        singletons (int): Number of singleton observations dropped.
+    """
+    coefficients: pd.Series
+    covariance: pd.DataFrame
+    residuals: pd.Series
+    sample: pd.Series
+    nobs: int
+    df_a: int
+    df_r: int
+    nclusters: Optional[int] = None
+    singletons: int = 0
+
+    @property
+    def standard_errors(self) -> pd.Series:
+        return pd.Series(
+            np.sqrt(np.diag(self.covariance.to_numpy())),
+            index=self.coefficients.index
+        )
+
+
+def _codes(values: pd.Series) -> np.ndarray:
+    return pd.factorize(values, sort=True)[0]
+
+
+def drop_singletons(codes: Sequence[np.ndarray]) -> np.ndarray:
+    """Returns which observations are kept after iteratively dropping those
+    that are alone in a group of any fixed effect, as reghdfe does."""
+    nobs = len(codes[0]) if codes else 0
+    keep = np.ones(nobs, dtype=bool)
+    while True:
+        singleton = np.zeros(nobs, dtype=bool)
+        for fe in codes:
+            counts = np.bincount(fe[keep], minlength=fe.max() + 1 if nobs else 0)
+            singleton |= keep & (counts[fe] == 1)
+        if not singleton.any():
+            return keep
+        keep &= ~singleton
+
+
+def _indicators(codes: np.ndarray) -> Tuple[sparse.csr_matrix, np.ndarray]:
+    levels = codes.max() + 1
+    matrix = sparse.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), codes)),
+        shape=(len(codes), levels)
+    )
+    return matrix, np.bincount(codes, minlength=levels)
+
+
+def demean(
+    values: np.ndarray,
+    codes: Sequence[np.ndarray],
+    tol: float = 1e-8,
+    max_iter: int = 10000
+) -> np.ndarray:
+    """Partials the fixed effects out of each column of values by
+    alternating projections: the group means of one fixed effect after the
+    other are subtracted until the columns change less than tol (relative
+    to their scale). One fixed effect takes a single pass.
+
+    Args:
+        values (np.ndarray): Observations x variables.
+        codes (Sequence[np.ndarray]): Group codes (0, ..., G-1) of each
+        fixed effect.
+        tol (float): Tolerance of the largest change in an iteration.
+        max_iter (int): Maximum number of iterations.
+
+    Raises:
+        RuntimeError: Raised if the projections do not converge.
+    """
+    values = np.array(values, dtype=float, copy=True).reshape(len(values), -1)
+    if not codes:
+        return values
+    projections = [_indicators(x) for x in codes]
+    scale = np.maximum(np.abs(values).max(axis=0, initial=0.0), 1.0)
+    for _ in range(max_iter):
+        change = np.zeros(values.shape[1])
+        for matrix, counts in projections:
+            means = (matrix.T @ values) / counts[:, None]
+            update = matrix @ means
+            values -= update
+            change = np.maximum(change, np.abs(update).max(axis=0, initial=0.0))
+        if len(projections) == 1 or (change / scale).max(initial=0.0) < tol:
+            return values
+    raise RuntimeError(f'Fixed effects not partialled out after {max_iter} iterations.')
+
+
+def _redundant(codes: Sequence[np.ndarray], cluster: Optional[np.ndarray]) -> List[int]:
+    """Redundant levels of each fixed effect, as reghdfe counts them: all
+    levels of a fixed effect nested in the clusters, the connected
+    components of the first two fixed effects for the second, and one for
+    each further fixed effect."""
+    redundant = []
+    for i, fe in enumerate(codes):
+        if cluster is not None and (
+            pd.Series(cluster).groupby(fe).nunique() == 1
+        ).all():
+            redundant.append(fe.max() + 1)
+        elif i == 0:
+            redundant.append(0)
+        elif i == 1:
+            redundant.append(_bipartite_components(codes[0], fe))
+        else:
+            redundant.append(1)
+    return redundant
+
+
+def _bipartite_components(first: np.ndarray, second: np.ndarray) -> int:
+    n_first = first.max() + 1
+    n_second = second.max() + 1
+    edges = sparse.csr_matrix(
+        (np.ones(len(first)), (first, n_first + second)),
+        shape=(n_first + n_second, n_first + n_second)
+    )
+    return connected_components(edges, directed=False)[0]
+
+
+def reghdfe(
+    data: pd.DataFrame,
+    y: str,
+    x: Sequence[str] = (),
+    absorb: Sequence[str] = (),
+    vce: str = 'unadjusted',
+    cluster: Optional[str] = None,
+    keep_singletons: bool = False,
+    tol: float = 1e-8,
+    max_iter: int = 10000
+) -> HDFEResult:
+    """Regresses y on x, absorbing the fixed effects of the columns in
+    absorb (none: a constant only, like noabsorb), like Stata's reghdfe.
+
+    Rows with missing values in any of the columns are left out, and so
+    are singletons (unless keep_singletons). Standard errors follow
+    reghdfe: unadjusted, robust (scaled by N / df_r), or clustered
+    (scaled by (N - 1) / df_r * G / (G - 1)), where df_r = N - K - df_a
+    and fixed effects nested in the clusters do not count towards df_a.
+
+    Args:
+        data (pd.DataFrame): The data.
+        y (str): Dependent variable.
+        x (Sequence[str]): Regressors.
+        absorb (Sequence[str]): Columns with the groups of fixed effects.
+        vce (str): 'unadjusted', 'robust', or 'cluster'.
+        cluster (Optional[str]): Column with the clusters, for
+        vce='cluster'.
+        keep_singletons (bool): Keep singleton groups.
+        tol (float): Tolerance of the alternating projections.
+        max_iter (int): Maximum number of their iterations.
+
+    Returns:
+        HDFEResult: The estimates.
+
+    Raises:
+        ValueError: Raised if vce is unknown, cluster is missing, or no
+        observations are left.
+    """
+    if vce not in ('unadjusted', 'robust', 'cluster'):
+        raise ValueError(f'Unknown vce: {vce}')
+    if (vce == 'cluster') != (cluster is not None):
+        raise ValueError("Clusters need vce='cluster' and a cluster column.")
+    x = list(x)
+    columns = list(dict.fromkeys([y, *x, *absorb, *([cluster] if cluster else [])]))
+    sample = data[columns].notna().all(axis=1).to_numpy(copy=True)
+    codes = [_codes(data.loc[sample, fe]) for fe in absorb]
+    dropped = 0
+    if codes and not keep_singletons:
+        keep = drop_singletons(codes)
+        dropped = int((~keep).sum())
+        rows = np.flatnonzero(sample)
+        sample[rows[~keep]] = False
+        codes = [_codes(pd.Series(fe[keep])) for fe in codes]
+    subset = data.loc[sample]
+    values = subset[[y, *x]].to_numpy(dtype=float)
+    nobs = len(values)
+    if nobs == 0:
+        raise ValueError('No observations.')
+    means = values.mean(axis=0)
+    # Without fixed effects, only the constant is partialled out
+    demeaned = demean(values, codes or [np.zeros(nobs, dtype=int)], tol, max_iter)
+    clusters = _codes(subset[cluster]) if cluster else None
+    df_a = sum(
+        fe.max() + 1 - redundant
+        for fe, redundant in zip(codes, _redundant(codes, clusters))
+    )
+    # The constant, unless one of the fixed effects already absorbs it
+    df_a = max(df_a, 1)
+    # Regressors with the means added back, so that the constant and its
+    # standard error are estimated along
+    regressors = np.column_stack([demeaned[:, 1:] + means[1:], np.ones(nobs)])
+    dependent = demeaned[:, 0] + means[0]
+    beta, *_ = np.linalg.lstsq(regressors, dependent, rcond=None)
+    residuals = dependent - regressors @ beta
+    df_r = nobs - len(x) - df_a
+    bread = np.linalg.pinv(regressors.T @ regressors)
+    nclusters = None
+    if vce == 'unadjusted':
+        covariance = bread * (residuals @ residuals) / df_r
+    elif vce == 'robust':
+        scores = regressors * residuals[:, None]
+        covariance = bread @ (scores.T @ scores) @ bread * nobs / df_r
+    else:
+        nclusters = int(clusters.max() + 1)
+        indicator, _ = _indicators(clusters)
+        scores = indicator.T @ (regressors * residuals[:, None])
+        covariance = bread @ (scores.T @ scores) @ bread * (
+            (nobs - 1) / df_r * nclusters / (nclusters - 1)
+        )
+    names = [*x, '_cons']
+    full_residuals = np.full(len(data), np.nan)
+    full_residuals[sample] = residuals
+    return HDFEResult(
+        coefficients=pd.Series(beta, index=names),
+        covariance=pd.DataFrame(covariance, index=names, columns=names),
+        residuals=pd.Series(full_residuals, index=data.index),
+        sample=pd.Series(sample, index=data.index),
+        nobs=nobs,
+        df_a=int(df_a),
+        df_r=int(df_r),
+        nclusters=nclusters,
+        singletons=dropped,
+    )
+
+
+def residualize(
+    data: pd.DataFrame, y: str, absorb: Sequence[str], keep_singletons: bool = False
+) -> pd.Series:
+    """Residuals of y after absorbing fixed effects, like reghdfe y,
+    absorb(...) residuals(); missing outside of the estimation sample."""
+    return reghdfe(
+        data, y, absorb=absorb, keep_singletons=keep_singletons
+    ).residuals
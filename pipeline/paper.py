@@ -0,0 +1,6 @@
+""" Module providing the thresholds of the paper that both the data build
+and the analysis use """
+
+# Destinations of an origin with more firms (nr_of_firmsALL) enter the
+# right panel of Table 6; also the default of the crisis sweep
+TABLE6_MIN_FIRMS = 25
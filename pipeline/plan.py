@@ -0,0 +1,125 @@
+""" Module providing dry-run plans with estimates from earlier runs """
+from dataclasses import dataclass, field
+import json
+from pathlib import Path
+from statistics import median
+from typing import Dict, List, Optional, Tuple
+
+# Number of most recent successful runs of a step used for its estimate
+RECENT_RUNS = 5
+
+
+@dataclass
+class PlannedStep:
+    """A step of a dry run.
+
+    Args:
+        name (str): Name of the step.
+        status (str): 'up to date', 'stale' (runs because its code, inputs,
+        or outputs changed), 'after upstream' (runs if an upstream step
+        produces different output), 'always runs' (not tracked, e.g. the
+        figures and tables), or 'missing input' (would fail since an input
+        does not exist).
+        inputs (List[Path]): Files the step reads.
+        outputs (List[Path]): Files the step writes.
+        dependencies (List[str]): Steps whose outputs the step reads.
+        wall_seconds (Optional[float]): Median wall time of recent runs.
+        peak_mb (Optional[float]): Largest peak memory of recent runs.
+        runs (int): Number of recent runs the estimates are based on.
+    """
+    name: str
+    status: str
+    inputs: List[Path] = field(default_factory=list)
+    outputs: List[Path] = field(default_factory=list)
+    dependencies: List[str] = field(default_factory=list)
+    wall_seconds: Optional[float] = None
+    peak_mb: Optional[float] = None
+    runs: int = 0
+
+
+def load_estimates(history_file: Path) -> Dict[str, Tuple[float, float, int]]:
+    """Estimates the wall time and peak memory of each step from the run
+    history that Telemetry.append_history writes.
+
+    Returns:
+        Dict[str, Tuple[float, float, int]]: By step, the median wall time
+        (seconds) and the largest peak memory (MB, of the Python process
+        or of Stata, whichever is larger) of its recent successful runs,
+        and the number of these runs.
+    """
+    runs: Dict[str, List[dict]] = {}
+    if history_file.exists():
+        with history_file.open('r', encoding='utf-8') as infile:
+            for line in infile:
+                record = json.loads(line)
+                if record.get('status') == 'ok':
+                    runs.setdefault(record['step'], []).append(record)
+    estimates = {}
+    for step, records in runs.items():
+        recent = records[-RECENT_RUNS:]
+        estimates[step] = (
+            median(x['wall_seconds'] for x in recent),
+            max(max(x['peak_rss_mb'], x['child_peak_rss_mb']) for x in recent),
+            len(recent),
+        )
+    return estimates
+
+
+def add_estimates(planned: List[PlannedStep], history_file: Path) -> None:
+    """Fills in the estimates of planned steps from the run history."""
+    estimates = load_estimates(history_file)
+    for step in planned:
+        if step.name in estimates:
+            step.wall_seconds, step.peak_mb, step.runs = estimates[step.name]
+
+
+def _format_seconds(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+
+def print_plan(planned: List[PlannedStep], jobs: int = 1, verbose: bool = True) -> None:
+    """Prints the steps of a dry run with their estimates, and the estimated
+    total wall time and peak memory of the steps that would run.
+
+    Args:
+        planned (List[PlannedStep]): Steps in the order in which they run.
+        jobs (int): Maximum number of steps that run at the same time.
+        verbose (bool): Also print the inputs and outputs of each step.
+    """
+    print(f'{"step":<40} {"status":<15} {"wall time":>10} {"peak MB":>9} {"runs":>5}')
+    for step in planned:
+        peak = '?' if step.peak_mb is None else f'{step.peak_mb:.0f}'
+        print(
+            f'{step.name:<40} {step.status:<15} '
+            f'{_format_seconds(step.wall_seconds):>10} {peak:>9} {step.runs:>5}'
+        )
+        if verbose:
+            for path in step.inputs:
+                print(f'{"":<4}< {path}')
+            for path in step.outputs:
+                print(f'{"":<4}> {path}')
+    to_run = [x for x in planned if x.status != 'up to date']
+    unknown = [x.name for x in to_run if x.wall_seconds is None]
+    total = sum(x.wall_seconds or 0 for x in to_run)
+    print(f'{len(to_run)} of {len(planned)} steps would (or may) run.')
+    if not to_run:
+        return
+    # With several jobs, the steps that depend on each other still run
+    # one after another, so the longest such chain bounds the wall time
+    finish: Dict[str, float] = {}
+    for step in to_run:
+        start = max((finish.get(x, 0.0) for x in step.dependencies), default=0.0)
+        finish[step.name] = start + (step.wall_seconds or 0)
+    estimate = total if jobs <= 1 else max(max(finish.values()), total / jobs)
+    print(f'Estimated wall time: {_format_seconds(estimate)} (one after another: '
+          f'{_format_seconds(total)})')
+    peaks = sorted((x.peak_mb for x in to_run if x.peak_mb is not None), reverse=True)
+    if peaks:
+        print(f'Estimated peak memory: {sum(peaks[:max(jobs, 1)]):.0f} MB '
+              f'(largest single step: {peaks[0]:.0f} MB)')
+    if unknown:
+        print('No earlier runs of: ' + ', '.join(unknown))
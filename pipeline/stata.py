@@ -0,0 +1,161 @@
+""" Module providing the call of Stata do files in batch mode """
+import os
+from pathlib import Path
+import re
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import psutil
+
+from pipeline.telemetry import add_child_usage
+
+# Stata ends its output with the return code when a command fails
+ERROR_PATTERN = re.compile(r'^r\((\d+)\);\s*$')
+
+# Seconds a do file may run, by name of the do file (without .do) or
+# 'default'; None means no limit
+_timeouts: Dict[str, Optional[float]] = {}
+
+# Set to stop all do files that are running, e.g. after another failed
+_cancelled = threading.Event()
+
+
+class StataError(RuntimeError):
+    """Raised if a do file fails, times out, or is cancelled."""
+
+    def __init__(self, do_file: Path, message: str, log_lines: Sequence[str] = ()):
+        self.do_file = do_file
+        self.log_lines = list(log_lines)
+        text = f'{Path(do_file).name}: {message}'
+        if self.log_lines:
+            text += '\n' + '\n'.join(self.log_lines)
+        super().__init__(text)
+
+
+def set_timeouts(timeouts: Optional[Dict[str, Optional[float]]]) -> None:
+    """Sets the time limits of do files (in seconds), by name of the do
+    file or 'default' for all others."""
+    _timeouts.clear()
+    _timeouts.update(timeouts or {})
+
+
+def cancel_running() -> None:
+    """Stops all do files that are running in this process."""
+    _cancelled.set()
+
+
+class _LogTail:
+    """Reads the lines that were added to a log file since the last call."""
+
+    def __init__(self, log_file: Path, keep: int = 20):
+        self.log_file = log_file
+        self.keep = keep
+        self.position = 0
+        self.partial = ''
+        self.last_lines: List[str] = []
+
+    def read(self, final: bool = False) -> Optional[str]:
+        """Returns the Stata return code if the new lines contain an error.
+        Unless final, an unfinished last line is kept for the next call."""
+        try:
+            with self.log_file.open('r', encoding='utf-8', errors='replace') as infile:
+                infile.seek(self.position)
+                text = infile.read()
+                self.position = infile.tell()
+        except FileNotFoundError:
+            return None
+        lines = (self.partial + text).split('\n')
+        self.partial = '' if final else lines.pop()
+        for line in lines:
+            match = ERROR_PATTERN.match(line)
+            if match:
+                return match.group(1)
+            self.last_lines = (self.last_lines + [line])[-self.keep:]
+        return None
+
+
+def _stop(process: subprocess.Popen) -> tuple:
+    process.terminate()
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return 0, None
+    return status, rusage
+
+
+def run_stata(
+    stata_exec: str,
+    do_file: Path,
+    args: Sequence[str],
+    timeout: Optional[float] = None
+) -> None:
+    """Runs a do file in batch mode. The log file ends up in the current
+    working directory. The CPU time, peak memory, and I/O of the Stata
+    process are added to the active telemetry measurement, if any.
+
+    The log file is watched while Stata runs, so that an error stops the
+    do file (and the build) right away; Stata's batch mode itself does not
+    report errors in its exit code.
+
+    Args:
+        stata_exec (str): Command that calls Stata.
+        do_file (Path): The do file.
+        args (Sequence[str]): Arguments passed on to the do file.
+        timeout (Optional[float]): Seconds after which the do file is
+        stopped; defaults to the limit set with set_timeouts().
+
+    Raises:
+        StataError: Raised if the do file fails, exceeds its time limit,
+        or is cancelled.
+    """
+    do_file = Path(do_file)
+    if timeout is None:
+        timeout = _timeouts.get(do_file.stem, _timeouts.get('default'))
+    log = _LogTail(Path.cwd().joinpath(f'{do_file.stem}.log'))
+    # Remove the log of an earlier run, which may contain old errors
+    log.log_file.unlink(missing_ok=True)
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [stata_exec, '-q', '-b', 'do', f'"{do_file}"', *[str(x) for x in args]]
+    )
+    watched = psutil.Process(process.pid)
+    io_bytes = None
+    error = None
+    while True:
+        # Reap the process ourselves to get its resource usage
+        pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        try:
+            counters = watched.io_counters()
+            io_bytes = (counters.read_bytes, counters.write_bytes)
+        except (AttributeError, psutil.Error):
+            pass
+        code = log.read()
+        if code is not None:
+            error = f'failed with error r({code})'
+        elif timeout is not None and time.monotonic() - started > timeout:
+            error = f'stopped after the time limit of {timeout:.0f} seconds'
+        elif _cancelled.is_set():
+            error = 'cancelled because another step failed'
+        if error is not None:
+            status, rusage = _stop(process)
+            break
+        time.sleep(0.2)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if rusage is not None:
+        # ru_maxrss is in bytes on MacOS and in kilobytes on Linux
+        peak_rss = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        add_child_usage(rusage.ru_utime + rusage.ru_stime, peak_rss, io_bytes)
+    if error is None:
+        # The error may only have been written when Stata exited
+        code = log.read(final=True)
+        if code is not None:
+            error = f'failed with error r({code})'
+        elif process.returncode != 0:
+            error = f'exited with code {process.returncode}'
+    if error is not None:
+        raise StataError(do_file, error, log.last_lines)
@@ -0,0 +1,185 @@
+""" Module providing per-step timing, memory, and I/O measurements """
+from contextlib import contextmanager
+import csv
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime
+import json
+from pathlib import Path
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+import psutil
+
+MB = 1024 ** 2
+
+# The measurement that is active in the current thread (if any), so that
+# the Stata runner can add the usage of the child process to it
+_current = threading.local()
+
+
+@dataclass
+class StepUsage:
+    """Resources used by one step.
+
+    The CPU time, peak RSS, and I/O of the Python process are measured for
+    the whole process; if several steps run in parallel threads, they also
+    include the other steps. The child_* fields are measured for the
+    child processes (Stata) of the step alone. read_mb and written_mb are
+    None where the operating system does not report I/O (e.g., MacOS);
+    input_mb and output_mb are the sizes of the declared inputs and
+    outputs of the step.
+    """
+    step: str
+    started: str
+    status: str = 'running'
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    child_cpu_seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+    child_peak_rss_mb: float = 0.0
+    read_mb: Optional[float] = None
+    written_mb: Optional[float] = None
+    input_mb: float = 0.0
+    output_mb: float = 0.0
+
+
+def _io_counters(process: psutil.Process) -> Optional[tuple]:
+    try:
+        counters = process.io_counters()
+    except (AttributeError, psutil.Error):
+        return None
+    return (counters.read_bytes, counters.write_bytes)
+
+
+def _size_mb(paths: Iterable[Path]) -> float:
+    size = 0
+    for path in paths:
+        if path.is_dir():
+            size += sum(x.stat().st_size for x in path.rglob('*') if x.is_file())
+        elif path.exists():
+            size += path.stat().st_size
+    return size / MB
+
+
+class _RssSampler(threading.Thread):
+    """Polls the resident memory of a process until it is stopped."""
+
+    def __init__(self, process: psutil.Process, interval: float = 0.1):
+        super().__init__(daemon=True)
+        self.process = process
+        self.interval = interval
+        self.peak = process.memory_info().rss
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.peak = max(self.peak, self.process.memory_info().rss)
+            except psutil.Error:
+                return
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def add_child_usage(
+    cpu_seconds: float,
+    peak_rss_bytes: int,
+    io_bytes: Optional[tuple] = None
+) -> None:
+    """Adds the usage of a finished child process to the measurement that
+    is active in the current thread. Does nothing outside of measure()."""
+    usage = getattr(_current, 'usage', None)
+    if usage is None:
+        return
+    usage.child_cpu_seconds += cpu_seconds
+    usage.child_peak_rss_mb = max(usage.child_peak_rss_mb, peak_rss_bytes / MB)
+    if io_bytes is not None and usage.read_mb is not None:
+        usage.read_mb += io_bytes[0] / MB
+        usage.written_mb += io_bytes[1] / MB
+
+
+class Telemetry:
+    """Collects the resource usage of all steps of a run."""
+
+    def __init__(self):
+        self.records: List[StepUsage] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(
+        self,
+        step: str,
+        inputs: Iterable[Path] = (),
+        outputs: Iterable[Path] = ()
+    ) -> Iterator[StepUsage]:
+        process = psutil.Process()
+        usage = StepUsage(
+            step=step,
+            started=datetime.now().isoformat(timespec='seconds'),
+            input_mb=_size_mb(inputs),
+        )
+        sampler = _RssSampler(process)
+        sampler.start()
+        cpu_start = process.cpu_times()
+        io_start = _io_counters(process)
+        if io_start is not None:
+            usage.read_mb, usage.written_mb = 0.0, 0.0
+        wall_start = time.perf_counter()
+        _current.usage = usage
+        try:
+            yield usage
+            usage.status = 'ok'
+        except BaseException:
+            usage.status = 'failed'
+            raise
+        finally:
+            _current.usage = None
+            usage.wall_seconds = time.perf_counter() - wall_start
+            cpu_end = process.cpu_times()
+            usage.cpu_seconds = (
+                cpu_end.user - cpu_start.user + cpu_end.system - cpu_start.system
+            )
+            usage.peak_rss_mb = sampler.stop() / MB
+            io_end = _io_counters(process)
+            if io_start is not None and io_end is not None:
+                usage.read_mb += (io_end[0] - io_start[0]) / MB
+                usage.written_mb += (io_end[1] - io_start[1]) / MB
+            usage.output_mb = _size_mb(outputs)
+            self.add(usage)
+
+    def add(self, usage: StepUsage) -> None:
+        with self._lock:
+            self.records.append(usage)
+
+    def append_history(self, history_file: Path) -> None:
+        """Appends the records of this run to a JSON lines file that is
+        kept across runs, for the estimates of the dry runs."""
+        with history_file.open('a', encoding='utf-8') as outfile:
+            for record in self.records:
+                outfile.write(json.dumps(asdict(record)) + '\n')
+
+    def write_report(self, log_folder: Path, name: str) -> Path:
+        """Writes the run report as JSON and CSV to the log folder.
+
+        Args:
+            log_folder (Path): Folder of the report.
+            name (str): Prefix of the file names, e.g. 'data'.
+
+        Returns:
+            Path: The JSON file.
+        """
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        json_file = log_folder.joinpath(f'{name}_run_report_{stamp}.json')
+        with json_file.open('w', encoding='utf-8') as outfile:
+            json.dump([asdict(x) for x in self.records], outfile, indent=1)
+        with json_file.with_suffix('.csv').open('w', encoding='utf-8', newline='') as outfile:
+            writer = csv.DictWriter(
+                outfile, fieldnames=[x.name for x in fields(StepUsage)]
+            )
+            writer.writeheader()
+            writer.writerows(asdict(x) for x in self.records)
+        return json_file